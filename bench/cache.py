@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+"""
+Cache format benchmark.
+
+Stores the fixture data of a number of locations in each cache format and
+reports the size on disk, the time to decode all features of a location and
+the time to load them into the data model as done by every fetch, including
+reading the files.
+"""
+
+import argparse
+import os
+import shutil
+import timeit
+
+from common import fixture, home, cleanup
+
+import model
+from cache import Cache, SERIALIZERS
+from weather import FEATURES
+
+parser = argparse.ArgumentParser(description='Benchmark cache formats.')
+parser.add_argument('-f', '--fixture', type=str, default='clear',
+                    help='fixture data to store')
+parser.add_argument('-l', '--locations', type=int, default=100,
+                    help='number of cached locations')
+parser.add_argument('-n', '--repeat', type=int, default=20,
+                    help='number of loads of each location')
+args = parser.parse_args()
+
+data = model.parse(fixture(args.fixture))
+parts = dict((feature, model.dump(dict((s, data[s]) for s in sections
+                                       if s in data)))
+             for feature, (sections, ttl) in FEATURES.items())
+keys = ['location{}.{}'.format(i, feature) for i in range(args.locations)
+        for feature in parts]
+
+path = home()
+try:
+    print 'fixture: {}, locations: {}'.format(args.fixture, args.locations)
+    print '{:<10} {:>12} {:>10} {:>10}'.format(
+        'format', 'kB/location', 'decode ms', 'load ms')
+    for name in sorted(SERIALIZERS):
+        folder = os.path.join(path, name)
+        cache = Cache(folder, format=name)
+        for key in keys:
+            cache.store(key, parts[key.partition('.')[2]])
+        size = sum(os.path.getsize(os.path.join(folder, f))
+                   for f in os.listdir(folder))
+        texts = [cache.read(cache.path(key)) for key in keys]
+
+        def decode():
+            for text in texts:
+                cache.serializer.loads(text)
+
+        def load():
+            for key in keys:
+                model.load(cache.load(key))
+
+        per = args.locations * args.repeat / 1000.0
+        print '{:<10} {:12.1f} {:10.3f} {:10.3f}'.format(
+            name, size / 1024.0 / args.locations,
+            min(timeit.repeat(decode, number=args.repeat, repeat=3)) / per,
+            min(timeit.repeat(load, number=args.repeat, repeat=3)) / per)
+        shutil.rmtree(folder)
+finally:
+    cleanup(path)
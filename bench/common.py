@@ -0,0 +1,75 @@
+"""
+Shared helpers for the benchmarks.
+
+Benchmarks run against a throwaway home folder seeded with fixture data, so
+they need neither an API key nor network access.
+"""
+
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+
+BENCH = os.path.split(os.path.abspath(__file__))[0]
+ROOT = os.path.split(BENCH)[0]
+FIXTURES = os.path.join(BENCH, 'fixtures')
+SCRIPT = os.path.join(ROOT, 'weather.py')
+
+sys.path.insert(0, ROOT)
+
+def fixture(name):
+    """ Return parsed fixture data. """
+    with open(os.path.join(FIXTURES, name + '.json')) as f:
+        return json.load(f)
+
+
+def home():
+    """ Return a new temporary home folder with an API key. """
+    path = tempfile.mkdtemp(prefix='weather-bench-')
+    os.mkdir(path + '/.weather')
+    with open(path + '/.weather/API.key', 'w') as f:
+        print >>f, 'BENCHKEY'
+    return path
+
+
+def seed(path, query, name, format='marshal'):
+    """ Store fixture as fresh cached data for query in home folder. """
+    import model
+    from cache import Cache
+    from weather import FEATURES
+
+    data = model.parse(fixture(name))
+    cache = Cache(path + '/.weather', format=format)
+    key = re.sub(r'\W', '_', query)
+    for feature, (sections, ttl) in FEATURES.items():
+        part = model.dump(dict((s, data[s]) for s in sections if s in data))
+        cache.store(key + '.' + feature, part)
+
+
+def cleanup(path):
+    """ Remove temporary home folder. """
+    shutil.rmtree(path, ignore_errors=True)
+
+
+def measure(func, repeat=20, number=1):
+    """
+    Return sorted wall times of repeated calls in milliseconds.
+
+    Each of the repeat samples is the mean of number calls.
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        for _ in range(number):
+            func()
+        times.append((time.time() - start) * 1000 / number)
+    return sorted(times)
+
+
+def report(name, times):
+    """ Print median and worst time. """
+    print '{:<40} median {:8.2f} ms   max {:8.2f} ms'.format(
+        name, times[len(times) // 2], times[-1])
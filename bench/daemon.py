@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+"""
+Compare panel update latency of the cold CLI and the resident daemon.
+
+Runs `weather.py -u` as a new process, the same with a daemon running, and a
+direct socket read from the daemon, all on cached fixture data.
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+from common import SCRIPT, home, seed, cleanup, measure, report
+
+import daemon
+
+parser = argparse.ArgumentParser(description='Benchmark panel updates.')
+parser.add_argument('-n', '--repeat', type=int, default=20,
+                    help='number of updates per case')
+args = parser.parse_args()
+
+path = home()
+seed(path, 'bench', 'clear')
+env = dict(os.environ, HOME=path)
+os.environ['HOME'] = path
+devnull = open(os.devnull, 'w')
+
+
+def cli():
+    subprocess.check_call([sys.executable, SCRIPT, '-u', 'bench'],
+                          env=env, stdout=devnull)
+
+try:
+    report('cold CLI (weather.py -u)', measure(cli, args.repeat))
+    server = subprocess.Popen([sys.executable, SCRIPT, '-d', 'bench'],
+                              env=env, stdout=devnull)
+    while daemon.request('bench') is None:
+        time.sleep(0.05)
+    report('CLI with daemon (weather.py -u)', measure(cli, args.repeat))
+    report('socket read (daemon.request)',
+           measure(lambda: daemon.request('bench'), args.repeat))
+    server.terminate()
+    server.wait()
+finally:
+    cleanup(path)
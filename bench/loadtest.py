@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+"""
+Load test of the HTTP service against the stub API.
+
+Runs service.py in this process on a throwaway home folder, with the stub API
+answering after an artificial latency. Client threads send requests in two
+rounds: a burst of all clients asking for the same page of a location not
+fetched yet, then a mixed load of all renderers for several locations and
+scales. Reports requests per second, median and 99th percentile latency, and
+the API calls, fetches and renders it took.
+"""
+
+import argparse
+import httplib
+import json
+import os
+import random
+import threading
+import time
+
+from common import home, cleanup
+
+from service import RENDERERS, WeatherService
+from stubserver import StubServer
+
+parser = argparse.ArgumentParser(description='Load test the HTTP service.')
+parser.add_argument('-c', '--clients', type=int, default=32,
+                    help='number of concurrent clients')
+parser.add_argument('-n', '--requests', type=int, default=50,
+                    help='requests per client in the mixed round')
+parser.add_argument('-l', '--locations', type=int, default=10,
+                    help='number of locations in the mixed round')
+parser.add_argument('-w', '--workers', type=int, default=8,
+                    help='worker threads of the service')
+parser.add_argument('-L', '--latency', type=float, default=0.2,
+                    help='latency of the stub API in seconds')
+args = parser.parse_args()
+
+path = home()
+os.environ['HOME'] = path
+stub = StubServer(('127.0.0.1', 0), args.latency)
+api = stub.start()
+stub_host = '{}:{}'.format(*stub.server_address)
+service = WeatherService(('127.0.0.1', 0), args.workers, api=api,
+                         quota=(10 ** 6, 10 ** 6))
+thread = threading.Thread(target=service.serve_forever)
+thread.daemon = True
+thread.start()
+host = '{}:{}'.format(*service.server_address)
+
+
+def get(url, address=host):
+    """ Return status and body of a GET request to a server. """
+    conn = httplib.HTTPConnection(address, timeout=60)
+    try:
+        conn.request('GET', url)
+        res = conn.getresponse()
+        return res.status, res.read()
+    finally:
+        conn.close()
+
+
+def api_calls():
+    """ Return number of requests the stub API has answered. """
+    return sum(json.loads(get('/stats', stub_host)[1]).values())
+
+
+def run(name, urls):
+    """ Send the lists of URLs by one client thread each and report. """
+    times = []
+    errors = []
+    start = threading.Event()
+
+    def client(urls):
+        start.wait()
+        for url in urls:
+            begin = time.time()
+            status, body = get(url)
+            times.append((time.time() - begin) * 1000)
+            if status != 200:
+                errors.append(status)
+
+    before = dict(service.counters)
+    calls = api_calls()
+    threads = [threading.Thread(target=client, args=(u,)) for u in urls]
+    for t in threads:
+        t.start()
+    begin = time.time()
+    start.set()
+    for t in threads:
+        t.join()
+    seconds = time.time() - begin
+    times.sort()
+    after = service.counters
+    print '{:<6} {:6} requests {:8.1f}/s  median {:8.2f} ms  ' \
+        'p99 {:8.2f} ms  errors {}'.format(
+            name, len(times), len(times) / seconds, times[len(times) // 2],
+            times[min(len(times) - 1, int(len(times) * 0.99))], len(errors))
+    print '       API calls {}, fetches {}, renders {}, page hits {}'.format(
+        api_calls() - calls,
+        after['fetches'] - before['fetches'],
+        after['renders'] - before['renders'],
+        after['page_hits'] - before['page_hits'])
+
+
+try:
+    print 'clients {}, workers {}, API latency {} s'.format(
+        args.clients, args.workers, args.latency)
+    run('burst', [['/build_main?q=burst']] * args.clients)
+    fixtures = ['clear', 'snow', 'alerts', 'night', 'missing']
+    rand = random.Random(0)
+    urls = [['/{}?q={}&mult={}'.format(
+        rand.choice(RENDERERS),
+        fixtures[i % len(fixtures)] + ('' if i < len(fixtures) else str(i)),
+        rand.choice((1, 1.5)))
+        for i in (rand.randrange(args.locations)
+                  for _ in range(args.requests))]
+        for _ in range(args.clients)]
+    run('mixed', urls)
+finally:
+    service.shutdown()
+    stub.shutdown()
+    cleanup(path)
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+"""
+Memory per GUI tab with the lightweight and the stock WebKit profile.
+
+For each profile a child process loads the tabs of a fixture several times
+over in a hidden window, keeping all views, and reports the growth of its
+resident set size per loaded tab. Needs PyQt4 and a display, otherwise the
+profiles are reported unavailable.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+from common import BENCH, ROOT, home, cleanup
+
+# child process: prints resident set growth in kB and number of tabs
+CHILD = r"""
+import json, sys, time
+sys.path.insert(0, sys.argv[1])
+from PyQt4.QtCore import QEventLoop
+import model, stats, weather
+from common import fixture
+from quicktabs import LIGHT, QuickTabs
+
+
+def rss():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+
+
+w = weather.Weather('bench')
+w.update(model.parse(fixture(sys.argv[2])))
+stats.enable('/dev/null')
+app, win = QuickTabs.App(740, 580, timeout=0, show=False,
+                         profile=LIGHT if sys.argv[3] == 'light' else None)
+win.keep = 1000
+win.prefetch = False
+app.processEvents()
+before = rss()
+win.addTabs(weather.build_tabs(w) * int(sys.argv[4]))
+for index in range(win.count()):
+    win.load(index, False)
+start = time.time()
+while stats.TIMERS.get('tab.load', (0,))[0] < win.count():
+    if time.time() > start + 60:
+        sys.exit(1)
+    app.processEvents(QEventLoop.AllEvents, 50)
+print json.dumps([rss() - before, win.count()])
+"""
+
+parser = argparse.ArgumentParser(description='Measure memory per GUI tab.')
+parser.add_argument('-f', '--fixture', type=str, default='clear',
+                    help='fixture data to show')
+parser.add_argument('-c', '--copies', type=int, default=4,
+                    help='times the tabs of the fixture are loaded')
+args = parser.parse_args()
+
+path = home()
+env = dict(os.environ, HOME=path, PYTHONPATH=BENCH)
+devnull = open(os.devnull, 'w')
+try:
+    for profile in ('light', 'stock'):
+        child = subprocess.Popen([sys.executable, '-c', CHILD, ROOT,
+                                  args.fixture, profile, str(args.copies)],
+                                 env=env, stdout=subprocess.PIPE,
+                                 stderr=devnull)
+        out = child.communicate()[0]
+        if child.returncode:
+            print '{:<6} unavailable'.format(profile)
+            continue
+        growth, tabs = json.loads(out)
+        print '{:<6} {:3} tabs  {:8} kB  {:8.0f} kB per tab'.format(
+            profile, tabs, growth, float(growth) / tabs)
+finally:
+    cleanup(path)
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+"""
+Micro-benchmark of the HTML renderers.
+
+Times each tab renderer and the panel message on fixture data, reporting the
+best of five runs. With --rev, the renderers of an older git revision are
+timed instead, so that the numbers can be compared before and after a change.
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import timeit
+
+from common import ROOT, fixture, home, cleanup
+
+RENDERERS = ('build_main', 'hours_large', 'days_large', 'txtdays', 'alerts',
+             'message')
+
+parser = argparse.ArgumentParser(description='Benchmark renderers.')
+parser.add_argument('-f', '--fixture', type=str, default='clear',
+                    help='fixture data to render')
+parser.add_argument('-n', '--repeat', type=int, default=500,
+                    help='number of renders per renderer')
+parser.add_argument('-r', '--rev', type=str, default=None,
+                    help='git revision to benchmark instead of the tree')
+args = parser.parse_args()
+
+path = home()
+os.environ['HOME'] = path
+source = ROOT
+if args.rev:
+    source = tempfile.mkdtemp(dir=path)
+    archive = subprocess.Popen(['git', 'archive', args.rev], cwd=ROOT,
+                               stdout=subprocess.PIPE)
+    subprocess.check_call(['tar', '-x', '-C', source], stdin=archive.stdout)
+    archive.wait()
+sys.path.insert(0, source)
+# older revisions parse arguments on import
+sys.argv = ['weather.py', 'bench']
+devnull = open(os.devnull, 'w')
+stdout, sys.stdout = sys.stdout, devnull
+import weather
+sys.stdout = stdout
+
+try:
+    data = fixture(args.fixture)
+    w = weather.Weather('bench')
+    if hasattr(weather, 'model'):
+        w.update(weather.model.parse(data))
+    else:
+        w.data = data
+        w.alert = bool(data.get('alerts'))
+    print 'revision: {}, fixture: {}'.format(args.rev or 'working tree',
+                                            args.fixture)
+    for name in RENDERERS:
+        render = getattr(w, name)
+        sys.stdout = devnull
+        seconds = min(timeit.repeat(render, number=args.repeat, repeat=5))
+        sys.stdout = stdout
+        print '{:<12} {:10.1f} us'.format(name, seconds / args.repeat * 1e6)
+finally:
+    sys.stdout = stdout
+    cleanup(path)
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+"""
+Benchmark suite of the hot paths on all fixtures.
+
+The fixtures are recorded API responses: clear (plain days), snow (snowfall
+in the forecasts), alerts (active alerts), night (night icons) and missing
+(fields left out). For each of them the suite times
+
+    fetch/cold     fetch with an empty cache from the stub API, no latency
+    fetch/warm     fetch of fresh data from the cache
+    render/NAME    each tab renderer and the panel message
+    tabs           loading all GUI tabs until loadFinished, in a hidden window
+
+Tabs are timed in a child process and reported unavailable without PyQt4 or
+a display. Each case reports the median and 90th percentile time per call and
+the calls per second at the median, with garbage collection off while timing.
+Results can be saved as JSON and compared to a saved run, e.g. of the parent
+revision, flagging cases slower or faster by more than a threshold.
+"""
+
+import argparse
+import gc
+import glob
+import json
+import os
+import platform
+import subprocess
+import sys
+
+from common import FIXTURES, ROOT, home, seed, cleanup, measure
+
+import model
+import weather
+from stubserver import StubServer
+
+RENDERERS = ('build_main', 'hours_large', 'days_large', 'txtdays', 'alerts',
+             'message')
+
+# child process timing the GUI tabs: prints times in ms as a JSON list
+TABS = r"""
+import json, sys, time
+sys.path.insert(0, sys.argv[1])
+from PyQt4.QtCore import QEventLoop
+import model, stats, weather
+from common import fixture
+from quicktabs import QuickTabs
+
+w = weather.Weather('bench')
+w.update(model.parse(fixture(sys.argv[2])))
+stats.enable('/dev/null')
+app, win = QuickTabs.App(740, 580, timeout=0, show=False)
+win.keep = 100
+times = []
+for _ in range(int(sys.argv[3])):
+    start = time.time()
+    win.setTabs(weather.build_tabs(w))
+    target = stats.TIMERS.get('tab.load', (0,))[0] + win.count()
+    for index in range(win.count()):
+        win.load(index, False)
+    while stats.TIMERS.get('tab.load', (0,))[0] < target:
+        if time.time() > start + 30:
+            sys.exit(1)
+        app.processEvents(QEventLoop.AllEvents, 50)
+    times.append((time.time() - start) * 1000)
+    for index in range(win.count()):
+        win.widget(index).release()
+    app.processEvents()
+print json.dumps(times)
+"""
+
+parser = argparse.ArgumentParser(description='Run the benchmark suite.')
+parser.add_argument('fixtures', type=str, nargs='*',
+                    default=sorted(os.path.basename(name)[:-5] for name
+                                   in glob.glob(FIXTURES + '/*.json')),
+                    help='fixtures to use, all by default')
+parser.add_argument('-n', '--repeat', type=int, default=20,
+                    help='number of timed samples per case')
+parser.add_argument('-N', '--number', type=int, default=50,
+                    help='calls per sample of the renderers')
+parser.add_argument('-s', '--skip', type=str, default='',
+                    help='comma separated case groups to skip '
+                    '(fetch, render, tabs)')
+parser.add_argument('-o', '--output', type=str, default=None,
+                    help='save results as JSON')
+parser.add_argument('-c', '--compare', type=str, default=None,
+                    help='compare to results saved earlier')
+parser.add_argument('-t', '--threshold', type=float, default=0.1,
+                    help='relative change reported as slower or faster')
+args = parser.parse_args()
+skip = args.skip.split(',')
+
+path = home()
+os.environ['HOME'] = path
+server = StubServer(('127.0.0.1', 0))
+api = server.start()
+devnull = open(os.devnull, 'w')
+results = {}
+
+
+def timed(case, func, number=1):
+    """ Time a case and report it. """
+    gc.collect()
+    gc.disable()
+    try:
+        times = measure(func, args.repeat, number)
+    finally:
+        gc.enable()
+    summarize(case, times)
+
+
+def summarize(case, times):
+    """ Keep and print results of a case given its sorted times. """
+    result = {'median_ms': times[len(times) // 2],
+              'p90_ms': times[int(len(times) * 0.9)]}
+    result['per_s'] = 1000.0 / result['median_ms'] \
+        if result['median_ms'] else 0.0
+    results[case] = result
+    print '{:<30} median {:9.3f} ms  p90 {:9.3f} ms  {:10.1f} /s'.format(
+        case, result['median_ms'], result['p90_ms'], result['per_s'])
+
+
+def cold(name):
+    """ Return function fetching with an empty cache. """
+    w = weather.Weather(name, api=api, quota=(10 ** 6, 10 ** 6))
+
+    def fetch():
+        for feature in weather.FEATURES:
+            try:
+                os.unlink(w.cache.path(w.key + '.' + feature))
+            except OSError:
+                pass
+        w.fetch(background=False)
+    return fetch
+
+
+def tabs(name):
+    """ Return GUI tab loading times from a child process, or None. """
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(FIXTURES))
+    child = subprocess.Popen([sys.executable, '-c', TABS, ROOT, name,
+                              str(args.repeat)], env=env,
+                             stdout=subprocess.PIPE, stderr=devnull)
+    out = child.communicate()[0]
+    if child.returncode:
+        return None
+    return sorted(json.loads(out))
+
+
+try:
+    print 'python {}, {}, repeat {}'.format(
+        platform.python_version(), platform.machine(), args.repeat)
+    for name in args.fixtures:
+        if 'fetch' not in skip:
+            timed(name + ' fetch/cold', cold(name))
+            seed(path, name, name)
+            w = weather.Weather(name, api=api)
+            timed(name + ' fetch/warm', w.fetch)
+        if 'render' not in skip:
+            w = weather.Weather(name)
+            with open(os.path.join(FIXTURES, name + '.json')) as f:
+                w.update(model.parse(json.load(f)))
+            for renderer in RENDERERS:
+                render = getattr(w, renderer)
+                timed('{} render/{}'.format(name, renderer), render,
+                      args.number)
+        if 'tabs' not in skip:
+            times = tabs(name)
+            if times is None:
+                print '{:<30} unavailable'.format(name + ' tabs')
+            else:
+                summarize(name + ' tabs', times)
+finally:
+    server.shutdown()
+    cleanup(path)
+
+if args.output:
+    with open(args.output, 'w') as f:
+        json.dump({'python': platform.python_version(),
+                   'machine': platform.machine(), 'repeat': args.repeat,
+                   'results': results}, f, indent=1, sort_keys=True)
+
+if args.compare:
+    with open(args.compare) as f:
+        before = json.load(f)['results']
+    print
+    print 'compared to {} (threshold {:.0%})'.format(args.compare,
+                                                    args.threshold)
+    for case in sorted(set(before) & set(results)):
+        old, new = before[case]['median_ms'], results[case]['median_ms']
+        change = new / old - 1 if old else 0.0
+        verdict = ''
+        if max(old, new) < 0.01:
+            # below the timer resolution, e.g. renderers with nothing to show
+            verdict = 'too fast to compare'
+        elif change > args.threshold:
+            verdict = 'SLOWER'
+        elif change < -args.threshold:
+            verdict = 'faster'
+        print '{:<30} {:9.3f} -> {:9.3f} ms  {:+7.1%}  {}'.format(
+            case, old, new, change, verdict)
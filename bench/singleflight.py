@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+"""
+Cross-process single-flight check.
+
+Starts many processes fetching the same location at once against the local
+stub server, with the cache missing, expired and stale, and reports the
+number of upstream requests made in each round. With the processes waiting
+for each other there should be one request per round; with --wait 0 each
+process fetches by itself.
+"""
+
+import argparse
+import glob
+import json
+import os
+import subprocess
+import sys
+import time
+import urllib2
+
+from common import ROOT, home, cleanup
+from stubserver import StubServer
+
+CHILD = """
+import sys, weather
+w = weather.Weather('clear', api=sys.argv[1], wait=float(sys.argv[2]))
+w.fetch()
+w.render('message')
+"""
+
+parser = argparse.ArgumentParser(description='Check single-flight fetches.')
+parser.add_argument('-p', '--processes', type=int, default=20,
+                    help='number of simultaneous processes')
+parser.add_argument('-l', '--latency', type=float, default=0.5,
+                    help='latency of the stub server in seconds')
+parser.add_argument('-w', '--wait', type=float, default=10.0,
+                    help='seconds a process waits for another one fetching')
+args = parser.parse_args()
+
+server = StubServer(('127.0.0.1', 0), latency=args.latency)
+api = server.start()
+path = home()
+env = dict(os.environ, HOME=path)
+devnull = open(os.devnull, 'w')
+
+
+def requests():
+    """ Return number of upstream requests so far. """
+    stats = urllib2.urlopen(api.rsplit('/', 1)[0] + '/stats').read()
+    return json.loads(stats).get('clear', 0)
+
+
+def age(minutes):
+    """ Make all cached entries the given number of minutes old. """
+    then = time.time() - minutes * 60
+    for name in glob.glob(path + '/.weather/clear.*'):
+        if not name.endswith(('.lock', '.page')):
+            os.utime(name, (then, then))
+
+
+def run(name):
+    """ Run the processes at once and report requests and wall time. """
+    before = requests()
+    start = time.time()
+    procs = [subprocess.Popen([sys.executable, '-c', CHILD, api,
+                               str(args.wait)],
+                              cwd=ROOT, env=env, stdout=devnull)
+             for _ in range(args.processes)]
+    failed = sum(proc.wait() != 0 for proc in procs)
+    print '{:<8} {:>3} processes {:>3} failed {:>3} requests {:6.0f} ms' \
+        .format(name, args.processes, failed, requests() - before,
+                (time.time() - start) * 1000)
+
+try:
+    print 'wait: {} s, stub latency: {} s'.format(args.wait, args.latency)
+    run('missing')
+    age(13 * 60)
+    run('expired')
+    age(4 * 60)
+    run('stale')
+finally:
+    server.shutdown()
+    cleanup(path)
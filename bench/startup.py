@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+"""
+Startup latency benchmark.
+
+Measures wall time from starting a process until its first output: a bare
+interpreter, importing the weather module, the -u panel update and the GUI
+until the Summary tab is loaded. All cases run on cached fixture data, the
+GUI case needs PyQt4 and a display.
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+from common import ROOT, SCRIPT, home, seed, cleanup, report
+
+parser = argparse.ArgumentParser(description='Benchmark startup latency.')
+parser.add_argument('-n', '--repeat', type=int, default=20,
+                    help='number of starts per case')
+args = parser.parse_args()
+
+path = home()
+seed(path, 'bench', 'clear')
+env = dict(os.environ, HOME=path)
+devnull = open(os.devnull, 'w')
+
+
+def first_output(command):
+    """ Return function timing a process until its first output line. """
+    def run():
+        start = time.time()
+        proc = subprocess.Popen(command, env=env, cwd=ROOT,
+                                stdout=subprocess.PIPE, stderr=devnull)
+        line = proc.stdout.readline()
+        elapsed = time.time() - start
+        proc.kill()
+        proc.wait()
+        if not line:
+            raise RuntimeError("no output from " + ' '.join(command))
+        return elapsed * 1000
+    return run
+
+
+CASES = [('python', [sys.executable, '-c', 'print']),
+         ('import weather', [sys.executable, '-c',
+                             'import weather; print']),
+         ('weather.py -u', [sys.executable, SCRIPT, '-u', 'bench']),
+         ('weather.py (GUI loaded)', [sys.executable, SCRIPT, '--probe',
+                                      'bench'])]
+
+try:
+    for name, command in CASES:
+        run = first_output(command)
+        try:
+            report(name, sorted(run() for _ in range(args.repeat)))
+        except RuntimeError:
+            print '{:<40} unavailable'.format(name)
+finally:
+    cleanup(path)
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+"""
+Local stand-in for the Weather Underground API.
+
+Serves canned WU JSON from the fixtures folder with artificial latency, so
+that fetching can be exercised without an API key or network access.
+
+The query part of the URL selects the fixture (q/snow.json serves
+fixtures/snow.json), any other query gets the default fixture. Only the
+requested features are included in the response, like the real API does.
+Connections are kept alive (HTTP/1.1) and each request is served in its own
+thread. Request counts per query are available at /stats.
+
+Point the Weather class at the stub with the api option, e.g.
+Weather("clear", api="http://localhost:8642/api").
+"""
+
+import BaseHTTPServer
+import SocketServer
+import argparse
+import json
+import os
+import threading
+import time
+
+FIXTURES = os.path.join(os.path.split(os.path.abspath(__file__))[0],
+                        'fixtures')
+
+# data sections returned for each WU feature
+SECTIONS = {'alerts': ('alerts',),
+            'conditions': ('current_observation',),
+            'forecast10day': ('forecast',),
+            'hourly': ('hourly_forecast',),
+            }
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    """ Answer WU API requests with fixture data. """
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        """ Serve fixture data or request statistics. """
+        if self.path == '/stats':
+            with self.server.lock:
+                body = json.dumps(self.server.stats)
+            return self.reply(200, body)
+        parts = self.path.split('/')
+        try:
+            query = parts[parts.index('q') + 1].rsplit('.', 1)[0]
+            features = [p for p in parts[3:parts.index('q')] if ':' not in p]
+        except (ValueError, IndexError):
+            return self.reply(404, '{}')
+        with self.server.lock:
+            self.server.stats[query] = self.server.stats.get(query, 0) + 1
+        data = self.server.fixture(query)
+        body = {'response': data['response']}
+        for feature in features:
+            for section in SECTIONS.get(feature, ()):
+                if section in data:
+                    body[section] = data[section]
+        time.sleep(self.server.latency)
+        self.reply(200, json.dumps(body))
+
+    def reply(self, code, body):
+        """ Send a complete keep-alive response. """
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        """ Keep quiet. """
+        pass
+
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    """ Threaded HTTP server with fixture cache and request counters. """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, latency=0.0, default='clear'):
+        """ Bind the server and set up fixtures. """
+        BaseHTTPServer.HTTPServer.__init__(self, address, Handler)
+        self.latency = latency
+        self.default = default
+        self.fixtures = {}
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    def fixture(self, query):
+        """ Return parsed fixture for the query. """
+        if query not in self.fixtures:
+            name = os.path.join(FIXTURES, query + '.json')
+            if not os.path.exists(name):
+                name = os.path.join(FIXTURES, self.default + '.json')
+            with open(name) as f:
+                self.fixtures[query] = json.load(f)
+        return self.fixtures[query]
+
+    def start(self):
+        """ Serve in a background thread and return the API root URL. """
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return 'http://{}:{}/api'.format(*self.server_address)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Serve canned WU data.')
+    parser.add_argument('-p', '--port', type=int, default=8642,
+                        help='port to listen on')
+    parser.add_argument('-l', '--latency', type=float, default=0.2,
+                        help='artificial latency in seconds')
+    parser.add_argument('-d', '--default', type=str, default='clear',
+                        help='fixture used for unknown queries')
+    args = parser.parse_args()
+    server = StubServer(('localhost', args.port), args.latency, args.default)
+    print 'Serving on http://localhost:{}/api'.format(args.port)
+    server.serve_forever()
@@ -0,0 +1,272 @@
+"""
+File cache for weather data.
+
+Entries are files in a cache folder, written in one of the SERIALIZERS
+formats. Entries found in another format are converted on first use. An
+entry older than its time to live is stale but still usable: it is served at
+once while a fresh copy is fetched. Only entries older than the hard expiry
+are unusable. Updates are written to a temporary file and renamed over the
+entry, so readers never see a partial file. Entries not read for a number of
+days are evicted.
+
+Reading an entry sets its access time to now, while the modification time
+is kept as the time of the last update.
+
+Rendered pages are stored next to the entries, tagged with a fingerprint of
+everything they were rendered from, and reused while the tag matches.
+
+Processes sharing the folder can coordinate updates through per-key lock
+files, so that only one of them fetches new data at a time.
+"""
+
+import cPickle
+import errno
+import hashlib
+import json
+import marshal
+import os
+import tempfile
+import time
+import zlib
+from contextlib import contextmanager
+
+import stats
+
+
+class Serializer(object):
+
+    """ Format of cache entries: file extension and conversions. """
+
+    # errors raised by loads on damaged entries
+    ERRORS = (ValueError, TypeError, EOFError, zlib.error,
+              cPickle.UnpicklingError)
+
+    def __init__(self, ext, dumps, loads):
+        """ Set extension, function returning data as string and back. """
+        self.ext = ext
+        self.dumps = dumps
+        self.loads = loads
+
+
+def gzip_dumps(data):
+    """ Return data as gzip compressed compact JSON. """
+    compress = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    text = json.dumps(data, sort_keys=True, separators=(',', ':'))
+    return compress.compress(text) + compress.flush()
+
+
+def gzip_loads(text):
+    """ Return data from gzip compressed JSON. """
+    return json.loads(zlib.decompress(text, 16 + zlib.MAX_WBITS))
+
+
+SERIALIZERS = {
+    'json': Serializer('.json', lambda data: json.dumps(
+        data, sort_keys=True, indent=4, separators=(',', ': ')) + '\n',
+        json.loads),
+    'json.gz': Serializer('.json.gz', gzip_dumps, gzip_loads),
+    'marshal': Serializer('.marshal', lambda data: marshal.dumps(data, 2),
+                          marshal.loads),
+    'pickle': Serializer('.pickle', lambda data: cPickle.dumps(data, 2),
+                         cPickle.loads),
+}
+
+
+class Cache(object):
+
+    """ Folder of entries with stale-while-revalidate semantics. """
+
+    def __init__(self, home, ttl=5, expire=12 * 60, evict=30, format='json'):
+        """
+        Initialize cache in home folder.
+
+        Entries become stale after ttl minutes, unusable after expire
+        minutes and are evicted if not read for evict days. They are
+        stored in the named format of SERIALIZERS.
+        """
+        self.home = home
+        self.serializer = SERIALIZERS[format]
+        self.ttl = ttl
+        self.expire = expire
+        self.evict = evict
+        self.digests = {}
+        try:
+            os.mkdir(self.home)
+        except OSError:
+            pass
+
+    def path(self, key, ext=None):
+        """ Return file name for the key, of an entry by default. """
+        return os.path.join(self.home, key + (ext or self.serializer.ext))
+
+    def age(self, key):
+        """ Return age of the entry in minutes or None if missing. """
+        try:
+            return (time.time() - os.path.getmtime(self.path(key))) / 60.0
+        except OSError:
+            pass
+        if self.migrate(key):
+            return self.age(key)
+        return None
+
+    def migrate(self, key):
+        """
+        Convert entry stored in another format, returning if one was found.
+
+        The converted entry keeps the access and modification times, the
+        old file is removed.
+        """
+        for serializer in SERIALIZERS.values():
+            if serializer is self.serializer:
+                continue
+            name = self.path(key, serializer.ext)
+            try:
+                with open(name, 'rb') as f:
+                    data = serializer.loads(f.read())
+                times = os.path.getatime(name), os.path.getmtime(name)
+            except (IOError, OSError):
+                continue
+            except Serializer.ERRORS:
+                data = None
+            if data is not None:
+                self.write(self.path(key), self.serializer.dumps(data))
+                os.utime(self.path(key), times)
+            try:
+                os.unlink(name)
+            except OSError:
+                pass
+            return data is not None
+        return False
+
+    def state(self, key, ttl=None):
+        """
+        Return 'fresh', 'stale', 'expired' or 'missing'.
+
+        Optional ttl overrides the default time to live for this entry.
+        """
+        age = self.age(key)
+        if age is None:
+            return 'missing'
+        if age > self.expire:
+            return 'expired'
+        if age > (self.ttl if ttl is None else ttl):
+            return 'stale'
+        return 'fresh'
+
+    def load(self, key):
+        """
+        Return entry data or None, and mark the entry as used.
+
+        The digest of the entry content is kept in digests.
+        """
+        text = self.read(self.path(key))
+        if text is None:
+            stats.count('cache.miss')
+            return None
+        try:
+            with stats.timer('cache.decode'):
+                data = self.serializer.loads(text)
+        except Serializer.ERRORS:
+            stats.count('cache.miss')
+            return None
+        stats.count('cache.hit')
+        self.digests[key] = hashlib.sha1(text).hexdigest()
+        return data
+
+    def store(self, key, data):
+        """ Atomically replace entry data and update its digest. """
+        with stats.timer('cache.encode'):
+            text = self.serializer.dumps(data)
+        self.write(self.path(key), text)
+        self.digests[key] = hashlib.sha1(text).hexdigest()
+
+    @contextmanager
+    def lock(self, key, timeout=10.0):
+        """
+        Hold an exclusive lock of the key while in the context.
+
+        Waits up to timeout seconds for another process or thread holding
+        it, and yields whether the lock was acquired. The lock file records
+        the process id of the holder.
+        """
+        import fcntl
+
+        with open(self.path(key, '.lock'), 'a+') as f:
+            deadline = time.time() + timeout
+            while True:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except IOError as e:
+                    if e.errno not in (errno.EAGAIN, errno.EACCES):
+                        raise
+                if time.time() >= deadline:
+                    yield False
+                    return
+                time.sleep(0.05)
+            f.truncate(0)
+            f.write('{}\n'.format(os.getpid()))
+            f.flush()
+            try:
+                yield True
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def page(self, key, tag):
+        """
+        Return rendered page stored for the key, or None.
+
+        The page is only returned if it was stored with the same tag.
+        """
+        text = self.read(self.path(key, '.page'))
+        first, _, page = (text or '').partition('\n')
+        if first != '<!-- {} -->'.format(tag):
+            stats.count('page.miss')
+            return None
+        stats.count('page.hit')
+        return page.decode('utf-8')
+
+    def store_page(self, key, tag, page):
+        """ Atomically store rendered page with its tag. """
+        if isinstance(page, unicode):
+            page = page.encode('utf-8')
+        self.write(self.path(key, '.page'),
+                   '<!-- {} -->\n'.format(tag) + page)
+
+    def read(self, name):
+        """ Return file content or None, and mark the file as used. """
+        try:
+            with stats.timer('cache.read'):
+                with open(name, 'rb') as f:
+                    text = f.read()
+                os.utime(name, (time.time(), os.path.getmtime(name)))
+        except (IOError, OSError):
+            return None
+        return text
+
+    def write(self, name, text):
+        """ Atomically replace file content. """
+        fd, tmp = tempfile.mkstemp(dir=self.home, suffix='.tmp')
+        try:
+            with stats.timer('cache.write'):
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(text)
+                os.rename(tmp, name)
+        except:
+            os.unlink(tmp)
+            raise
+
+    def prune(self):
+        """ Remove entries, pages and locks not used for evict days. """
+        limit = time.time() - self.evict * 24 * 3600
+        exts = tuple(s.ext for s in SERIALIZERS.values()) + ('.page', '.lock')
+        for name in os.listdir(self.home):
+            if not name.endswith(exts):
+                continue
+            name = os.path.join(self.home, name)
+            try:
+                if max(os.path.getatime(name),
+                       os.path.getmtime(name)) < limit:
+                    os.unlink(name)
+            except OSError:
+                pass
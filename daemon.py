@@ -0,0 +1,101 @@
+"""
+Resident server for CommandRunner update messages.
+
+A daemon keeps one Weather instance in memory, refreshes outdated features on
+a schedule and keeps the rendered update message ready. Every connection to
+its Unix socket in ~/.weather receives the latest message, so a panel update
+is a socket read instead of a Python start, cache load and render. The socket
+is named after the location and the options the message depends on (font
+size, scale and cache format), so a panel with other options does not get a
+message rendered for another.
+
+The socket can be read by any small client, e.g. `nc -U`, or using request
+of the panel module, which weather.py uses before anything else is imported.
+"""
+
+import os
+import signal
+import SocketServer
+import sys
+import threading
+import time
+
+from panel import address, request
+
+
+class Handler(SocketServer.BaseRequestHandler):
+
+    """ Send the latest message and close the connection. """
+
+    def handle(self):
+        """ Write current message. """
+        self.request.sendall(self.server.message)
+        self.server.weather.quota.view(self.server.weather.key)
+
+
+class PanelDaemon(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+
+    """ Unix socket server with a scheduled refresh of the message. """
+
+    daemon_threads = True
+
+    def __init__(self, weather, interval=30):
+        """
+        Bind socket for a fetched Weather instance.
+
+        Outdated features are checked every interval seconds.
+        """
+        self.weather = weather
+        self.interval = interval
+        options = weather.size, weather.mult, weather.format
+        self.path = address(weather.query, *options)
+        if request(weather.query, *options) is not None:
+            raise RuntimeError("Daemon already running for " + weather.query)
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+        self.message = self.render()
+        SocketServer.UnixStreamServer.__init__(self, self.path, Handler)
+
+    def render(self):
+        """ Return encoded message, writing its click action if changed. """
+        self.weather.clickaction()
+        message = self.weather.message()
+        if isinstance(message, unicode):
+            message = message.encode('utf-8')
+        return message
+
+    def refresh(self):
+        """ Fetch outdated features and render new message, forever. """
+        from httplib import HTTPException
+
+        while True:
+            time.sleep(self.interval)
+            features = self.weather.outdated()
+            if not features:
+                continue
+            try:
+                self.weather.refresh(features)
+            except (IOError, ValueError, HTTPException):
+                # keep serving the last message
+                continue
+            self.message = self.render()
+
+    def run(self):
+        """ Serve until interrupted or terminated, then remove the socket. """
+        signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+        for target in (self.serve_forever, self.refresh):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+        try:
+            while True:
+                signal.pause()
+        except (KeyboardInterrupt, SystemExit):
+            pass
+        finally:
+            # stop serving before the interpreter tears the thread down
+            self.shutdown()
+            self.server_close()
+            os.unlink(self.path)
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+"""
+Static HTML export of many locations.
+
+Writes the tab pages (build_main, hours_large, days_large, txtdays and, with
+active alerts, alerts) and the panel message of each location to a folder
+per location in the output directory, e.g. out/OR_Eugene/build_main.html and
+out/OR_Eugene/message.xml. Locations are fetched and rendered by a pool of
+processes, usually one per core.
+
+A manifest.json in the output directory records a tag of the data and
+options each location was written with. Locations whose tag did not change
+since the last run are not written again. API calls of all processes count
+against the quota as usual, queueing for the per-minute limit rather than
+failing, so only the daily budget makes locations fail. The pages refer to
+the icons of this installation by file URLs. The panel messages name the
+click action script of this installation, but exporting never writes it.
+"""
+
+import hashlib
+import json
+import os
+
+from weather import FEATURES, Weather
+
+PAGES = ('build_main', 'hours_large', 'days_large', 'txtdays', 'alerts')
+
+
+def write(name, text):
+    """ Atomically replace file content. """
+    if isinstance(text, unicode):
+        text = text.encode('utf-8')
+    tmp = '{}.{}.tmp'.format(name, os.getpid())
+    with open(tmp, 'wb') as f:
+        f.write(text)
+    os.rename(tmp, name)
+
+
+def export(job):
+    """
+    Fetch a location and write its pages unless its tag is unchanged.
+
+    The job is a tuple (query, output directory, previous tag, options).
+    Returns a tuple (query, tag, folder name, written), with the error
+    message instead of the tag and written None if the location failed.
+    Runs in a pool process.
+    """
+    query, output, previous, options = job
+    try:
+        weather = Weather(query, **options)
+        weather.fetch(background=False)
+        digests = [weather.digests.get(feature)
+                   for feature in sorted(FEATURES)]
+        code = os.path.getmtime(weather.path + '/weather.py')
+        tag = hashlib.sha1(repr((digests, weather.mult, weather.size,
+                                 weather.stale, weather.path, code))
+                           ).hexdigest()
+        folder = os.path.join(output, weather.key)
+        if tag == previous and os.path.isdir(folder):
+            return query, tag, weather.key, False
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        for name in PAGES:
+            page = weather.render(name)
+            if page:
+                write(os.path.join(folder, name + '.html'), page)
+            elif os.path.exists(os.path.join(folder, name + '.html')):
+                os.unlink(os.path.join(folder, name + '.html'))
+        write(os.path.join(folder, 'message.xml'), weather.render('message'))
+        return query, tag, weather.key, True
+    except Exception as e:
+        return query, "{}: {}".format(type(e).__name__, e), None, None
+
+
+def run(queries, output, workers=None, **options):
+    """
+    Export locations by a pool of worker processes, one per core by default.
+
+    Options are passed on to Weather, API calls queue for the per-minute
+    quota unless queue is given as False. Failed locations are reported and
+    keep their previous pages. Returns the numbers of locations written,
+    unchanged and failed.
+    """
+    from multiprocessing import Pool
+
+    options.setdefault('queue', True)
+    if not os.path.isdir(output):
+        os.makedirs(output)
+    manifest_name = os.path.join(output, 'manifest.json')
+    try:
+        with open(manifest_name) as f:
+            manifest = json.load(f)
+    except (IOError, ValueError):
+        manifest = {}
+    jobs = [(query, output, manifest.get(query, {}).get('tag'), options)
+            for query in queries]
+    counts = {True: 0, False: 0, None: 0}
+    pool = Pool(workers)
+    try:
+        for query, tag, folder, written in pool.imap_unordered(export, jobs):
+            counts[written] += 1
+            if written is None:
+                print '{}: {}'.format(query, tag)
+                continue
+            manifest[query] = {'tag': tag, 'folder': folder}
+    finally:
+        pool.close()
+        pool.join()
+    write(manifest_name, json.dumps(manifest, indent=1, sort_keys=True))
+    return counts[True], counts[False], counts[None]
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+    import time
+
+    parser = argparse.ArgumentParser(
+        description='Write weather pages of many locations to a directory.')
+    parser.add_argument('locations', type=str, nargs='*',
+                        help='weather locations')
+    parser.add_argument('-i', '--input', type=argparse.FileType('r'),
+                        default=None,
+                        help='file with a location per line, - for stdin')
+    parser.add_argument('-o', '--output', type=str, default='weather-export',
+                        help='output directory')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='worker processes, one per core by default')
+    parser.add_argument('-m', '--mult', type=float, default=1.0,
+                        help='resize pages by the given factor')
+    parser.add_argument('-s', '--size', type=int, default=12,
+                        help='font size for the message string')
+    parser.add_argument('-q', '--quota', metavar='MINUTE,DAY',
+                        type=lambda text: tuple(int(n)
+                                                for n in text.split(',')),
+                        default=(10, 500),
+                        help='API calls allowed per minute and per day')
+    parser.add_argument('-a', '--api', type=str, default=None,
+                        help='API root URL, e.g. of bench/stubserver.py')
+    args = parser.parse_args()
+
+    queries = list(args.locations)
+    if args.input:
+        queries.extend(line.strip() for line in args.input if line.strip())
+    if not queries:
+        parser.error('no locations given')
+    options = {'mult': args.mult, 'size': args.size, 'quota': args.quota}
+    if args.api:
+        options['api'] = args.api
+    start = time.time()
+    written, unchanged, failed = run(queries, args.output, args.jobs,
+                                     **options)
+    print '{} written, {} unchanged, {} failed in {:.1f} s'.format(
+        written, unchanged, failed, time.time() - start)
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,327 @@
+"""
+Compact weather data model.
+
+Weather Underground responses are deeply nested dictionaries with numbers
+given as strings. They are normalized once into small records holding only
+the fields used by the renderers and the panel message, with numbers already
+parsed and night icons resolved. The cache stores records as plain lists.
+
+Model data is a dictionary with the keys current (Observation), hours (list
+of HourlyPoint), days (list of DailyPoint), texts (list of TextDay) and
+alerts (list of Alert), each present only if fetched.
+
+Hourly and daily forecasts are also summarized by series holding their numbers
+as columns, with aggregates like snow totals computed once.
+"""
+
+from array import array
+
+NAN = float('nan')
+
+
+def number(value):
+    """
+    Return a number given by the API as a number or a string.
+
+    Integral strings give integers, so that they are shown as before.
+    Missing or invalid values give None.
+    """
+    if isinstance(value, (int, long, float)):
+        return value
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return real(value)
+
+
+def real(value):
+    """ Return an API value as a float, None if missing or invalid. """
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def night(raw):
+    """ Return icon name without night prefix and if it is a night icon. """
+    name = raw.get("icon", "")
+    return (name.replace('nt_', ''),
+            '/nt_' in raw.get("icon_url", "") or 'nt_' in name)
+
+
+class Record(object):
+
+    """
+    Base of compact records with a fixed set of fields.
+
+    Fields are named by __slots__ and given in that order or by keywords.
+    Records are stored as plain lists of their values.
+    """
+
+    __slots__ = ()
+
+    def __init__(self, *values, **fields):
+        """ Set fields from positional values and keywords. """
+        for name, value in zip(self.__slots__, values):
+            setattr(self, name, value)
+        for name, value in fields.items():
+            setattr(self, name, value)
+
+    def dump(self):
+        """ Return list of field values. """
+        return [getattr(self, name) for name in self.__slots__]
+
+    @classmethod
+    def load(cls, values):
+        """ Return record from a list of values given by dump. """
+        if len(values) != len(cls.__slots__):
+            raise ValueError("{} needs {} values, got {}".format(
+                cls.__name__, len(cls.__slots__), len(values)))
+        return cls(*values)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.dump() == other.dump()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '{}({})'.format(type(self).__name__, ', '.join(
+            '{}={!r}'.format(name, getattr(self, name))
+            for name in self.__slots__))
+
+
+class Observation(Record):
+
+    """ Current conditions. """
+
+    __slots__ = ('icon', 'night', 'time', 'weather', 'temp', 'feels',
+                 'wind_dir', 'wind_kph', 'pressure', 'trend', 'url')
+
+    @classmethod
+    def parse(cls, raw):
+        """ Return observation from API current_observation section. """
+        icon, dark = night(raw)
+        return cls(icon=icon, night=dark,
+                   time=raw["local_time_rfc822"].replace(
+                       raw["local_tz_offset"], ''),
+                   weather=raw.get("weather"),
+                   temp=real(raw.get("temp_c")),
+                   feels=real(raw.get("feelslike_c")),
+                   wind_dir=raw.get("wind_dir"),
+                   wind_kph=number(raw.get("wind_kph")),
+                   pressure=number(raw.get("pressure_mb")),
+                   trend=raw.get("pressure_trend"),
+                   url=raw.get("forecast_url"))
+
+
+class HourlyPoint(Record):
+
+    """ Hourly forecast. """
+
+    __slots__ = ('hour', 'icon', 'night', 'code', 'condition', 'temp',
+                 'feels', 'pop', 'sky', 'qpf', 'snow', 'wind_dir',
+                 'wind_kph', 'pressure')
+
+    @classmethod
+    def parse(cls, raw):
+        """ Return point from an item of API hourly_forecast section. """
+        icon, dark = night(raw)
+        metric = lambda field: number(raw.get(field, {}).get("metric"))
+        return cls(hour=number(raw["FCTTIME"]["hour"]), icon=icon,
+                   night=dark, code=raw.get("fctcode", "0"),
+                   condition=raw.get("condition"), temp=metric("temp"),
+                   feels=metric("feelslike"), pop=number(raw.get("pop")),
+                   sky=number(raw.get("sky")), qpf=metric("qpf"),
+                   snow=metric("snow"),
+                   wind_dir=raw.get("wdir", {}).get("dir"),
+                   wind_kph=metric("wspd"), pressure=metric("mslp"))
+
+
+class DailyPoint(Record):
+
+    """ Daily forecast. """
+
+    __slots__ = ('weekday', 'icon', 'night', 'conditions', 'high', 'low',
+                 'pop', 'qpf', 'snow', 'wind_dir', 'wind_kph', 'wind_max')
+
+    @classmethod
+    def parse(cls, raw):
+        """ Return point from an item of API simpleforecast section. """
+        icon, dark = night(raw)
+        return cls(weekday=raw["date"]["weekday_short"], icon=icon,
+                   night=dark, conditions=raw.get("conditions"),
+                   high=number(raw.get("high", {}).get("celsius")),
+                   low=number(raw.get("low", {}).get("celsius")),
+                   pop=number(raw.get("pop")),
+                   qpf=number(raw.get("qpf_allday", {}).get("mm")),
+                   snow=number(raw.get("snow_allday", {}).get("cm")),
+                   wind_dir=raw.get("avewind", {}).get("dir"),
+                   wind_kph=number(raw.get("avewind", {}).get("kph")),
+                   wind_max=number(raw.get("maxwind", {}).get("kph")))
+
+
+class TextDay(Record):
+
+    """ Textual forecast for half a day. """
+
+    __slots__ = ('icon', 'night', 'title', 'text')
+
+    @classmethod
+    def parse(cls, raw):
+        """ Return text from an item of API txt_forecast section. """
+        icon, dark = night(raw)
+        return cls(icon=icon, night=dark, title=raw.get("title"),
+                   text=raw.get("fcttext_metric"))
+
+
+class Alert(Record):
+
+    """ Weather alert. """
+
+    __slots__ = ('description', 'expires', 'message')
+
+    @classmethod
+    def parse(cls, raw):
+        """ Return alert from an item of API alerts section. """
+        return cls(description=raw.get("description"),
+                   expires=raw.get("expires"), message=raw.get("message", ""))
+
+
+def total(column):
+    """ Return sum of a column, skipping missing values. """
+    return sum(value for value in column if value == value)
+
+
+def extent(column):
+    """ Return minimum and maximum of a column, None if all are missing. """
+    values = [value for value in column if value == value]
+    if not values:
+        return None, None
+    return min(values), max(values)
+
+
+class Series(object):
+
+    """
+    Forecast points held as columns of floats.
+
+    COLUMNS maps column names to point fields. Missing values are NaN.
+    Subclasses compute their aggregates once, on construction.
+    """
+
+    COLUMNS = {}
+
+    def __init__(self, points):
+        """ Build columns from a sequence of points. """
+        self.size = len(points)
+        for column, field in self.COLUMNS.items():
+            values = (getattr(point, field) for point in points)
+            setattr(self, column, array('d', (NAN if value is None else value
+                                              for value in values)))
+
+
+class HourlySeries(Series):
+
+    """
+    Hourly forecast columns.
+
+    Aggregates: snow total, temperature extent within the window of hours,
+    hour of precipitation onset (None if there is none) and pressure trend
+    over the next three hours ('+', '-' or '0').
+    """
+
+    COLUMNS = {'hour': 'hour', 'temp': 'temp', 'feels': 'feels',
+               'pop': 'pop', 'qpf': 'qpf', 'snow': 'snow', 'sky': 'sky',
+               'wind': 'wind_kph', 'pressure': 'pressure'}
+
+    def __init__(self, points, window=24, pop=50):
+        """
+        Build columns and aggregates.
+
+        Precipitation starts in the first hour with some precipitation or
+        its probability of at least pop percent.
+        """
+        super(HourlySeries, self).__init__(points)
+        self.snow_total = total(self.snow)
+        self.temp_min, self.temp_max = extent(self.temp[:window])
+        self.onset = None
+        for hour, qpf, chance in zip(self.hour, self.qpf, self.pop):
+            if qpf > 0 or chance >= pop:
+                self.onset = int(hour)
+                break
+        self.trend = '0'
+        change = self.pressure[min(3, self.size - 1)] - self.pressure[0] \
+            if self.size else NAN
+        if change > 0:
+            self.trend = '+'
+        elif change < 0:
+            self.trend = '-'
+
+
+class DailySeries(Series):
+
+    """
+    Daily forecast columns.
+
+    Aggregates: snow and precipitation totals, highest high and lowest low.
+    """
+
+    COLUMNS = {'high': 'high', 'low': 'low', 'pop': 'pop', 'qpf': 'qpf',
+               'snow': 'snow', 'wind': 'wind_kph', 'wind_max': 'wind_max'}
+
+    def __init__(self, points):
+        """ Build columns and aggregates. """
+        super(DailySeries, self).__init__(points)
+        self.snow_total = total(self.snow)
+        self.qpf_total = total(self.qpf)
+        self.low_min = extent(self.low)[0]
+        self.high_max = extent(self.high)[1]
+
+
+TYPES = {'current': Observation, 'hours': HourlyPoint, 'days': DailyPoint,
+         'texts': TextDay, 'alerts': Alert}
+
+
+def parse(response):
+    """ Return model data of the sections found in an API response. """
+    data = {}
+    if "current_observation" in response:
+        data['current'] = Observation.parse(response["current_observation"])
+    if "hourly_forecast" in response:
+        data['hours'] = [HourlyPoint.parse(hour)
+                         for hour in response["hourly_forecast"]]
+    if "forecast" in response:
+        forecast = response["forecast"]
+        data['days'] = [DailyPoint.parse(day) for day
+                        in forecast["simpleforecast"]["forecastday"]]
+        data['texts'] = [TextDay.parse(day) for day
+                         in forecast["txt_forecast"]["forecastday"]]
+    if "alerts" in response:
+        data['alerts'] = [Alert.parse(alert) for alert in response["alerts"]]
+    return data
+
+
+def dump(data):
+    """ Return model data as plain lists for storage. """
+    return dict((name, value.dump() if isinstance(value, Record)
+                 else [record.dump() for record in value])
+                for name, value in data.items())
+
+
+def load(stored):
+    """
+    Return model data from storage.
+
+    Unknown keys, e.g. raw API sections cached by older versions, are
+    skipped. Raises ValueError if records do not match the model.
+    """
+    data = {}
+    for name, value in stored.items():
+        if name not in TYPES:
+            continue
+        if name == 'current':
+            data[name] = TYPES[name].load(value)
+        else:
+            data[name] = [TYPES[name].load(values) for values in value]
+    return data
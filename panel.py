@@ -0,0 +1,134 @@
+"""
+Fast path of panel updates answered by a running daemon.
+
+`weather.py -u QUERY` runs this before importing anything else, so that an
+update served by the daemon costs little more than the Python start. Only
+the options a daemon's message depends on are understood here; any other
+command line returns None and goes the usual way through weather.main.
+"""
+
+import os
+import re
+
+# short and long names of the options taking a value, by destination
+VALUES = {'-s': 'size', '--size': 'size', '-m': 'mult', '--mult': 'mult',
+          '-f': 'format', '--format': 'format', '-q': None, '--quota': None,
+          '-t': None, '--deadline': None, '-l': None, '--live': None}
+FLAGS = {'-u': 'update', '--update': 'update', '-c': 'changed',
+         '--changed': 'changed'}
+
+
+def stem(query, size=12, mult=1.0, format='marshal'):
+    """ Return file name stem of the panel of a query and its options. """
+    return os.path.expanduser('~') + '/.weather/{}.{}.{:g}.{}'.format(
+        re.sub(r'\W', '_', query), size, mult, format)
+
+
+def address(query, size=12, mult=1.0, format='marshal'):
+    """ Return socket file name for the query and options. """
+    return stem(query, size, mult, format) + '.sock'
+
+
+def request(query, size=12, mult=1.0, format='marshal', timeout=1.0):
+    """
+    Return message from a running daemon, or None if there is none.
+
+    Only a daemon started with the same options answers.
+    """
+    import _socket
+
+    client = _socket.socket(_socket.AF_UNIX, _socket.SOCK_STREAM)
+    client.settimeout(timeout)
+    try:
+        client.connect(address(query, size, mult, format))
+        chunks = []
+        while True:
+            chunk = client.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    except _socket.error:
+        return None
+    finally:
+        client.close()
+    return ''.join(chunks)
+
+
+def changed(message, name):
+    """
+    Return if a message differs from the last one recorded in file name.
+
+    A changed message is recorded by its digest.
+    """
+    import hashlib
+
+    if isinstance(message, unicode):
+        message = message.encode('utf-8')
+    digest = hashlib.sha1(message).hexdigest()
+    try:
+        with open(name) as f:
+            if f.read() == digest:
+                return False
+    except IOError:
+        pass
+    tmp = '{}.{}.tmp'.format(name, os.getpid())
+    with open(tmp, 'w') as f:
+        f.write(digest)
+    os.rename(tmp, name)
+    return True
+
+
+def options(argv):
+    """
+    Return the options of a plain update command line, None for others.
+
+    The result holds query, size, mult, format and if_changed. Command
+    lines without -u or with any other option, e.g. -k or -d, give None.
+    """
+    found = {'size': '12', 'mult': '1.0', 'format': 'marshal'}
+    queries = []
+    args = list(argv)
+    try:
+        while args:
+            arg = args.pop(0)
+            if not arg.startswith('-') or arg == '-':
+                queries.append(arg)
+                continue
+            name, equals, value = arg.partition('=')
+            if not equals and name[:2] in VALUES and len(name) > 2 \
+                    and not name.startswith('--'):
+                name, value = name[:2], name[2:]
+            elif not equals and name in VALUES:
+                value = args.pop(0)
+            if name in VALUES:
+                if VALUES[name]:
+                    found[VALUES[name]] = value
+            elif name in FLAGS and not equals:
+                found[FLAGS[name]] = True
+            else:
+                return None
+        if len(queries) != 1 or not found.get('update'):
+            return None
+        return {'query': queries[0], 'size': int(found['size']),
+                'mult': float(found['mult']), 'format': found['format'],
+                'if_changed': found.get('changed', False)}
+    except (IndexError, ValueError):
+        return None
+
+
+def answer(query, size=12, mult=1.0, format='marshal', if_changed=False):
+    """
+    Print the update of a running daemon, returning if there was one.
+
+    With if_changed, nothing is printed if the update is the same as the
+    last one printed for these options.
+    """
+    import sys
+
+    message = request(query, size, mult, format)
+    if message is None:
+        return False
+    if not if_changed or changed(message,
+                                 stem(query, size, mult, format) + '.printed'):
+        sys.stdout.write(message + '\n')
+    return True
@@ -10,12 +10,364 @@ is pressed.
 Application always opens up in the middle of the screen and has no close button
 or window frame, hence it can be close only by the above described events.
 
-Each tab should have an HTML code, tab name and a size multiplier
+A resident window only hides on these events and pops up again on a signal,
+so that a prepared window can be shown without starting a new process.
+
+Each tab should have an HTML code, tab name and a size multiplier. Webpage
+views are created only for tabs that are shown, so the HTML code can also be
+given as a function producing it on demand.
+
+Tabs can also be produced by a job running in a background thread, while the
+window shows a placeholder. Each tab is filled in as soon as it is ready.
+
+Loaded tabs can also be updated live: new HTML code of the same structure only
+patches the changed text and attributes of the shown page through JavaScript,
+keeping loaded images and the scroll position. Pages with another structure,
+e.g. with an alert banner added, are loaded anew. A tab whose view went on to
+another page through a link is left alone and shows the new content once the
+tab is shown again.
+
+Views run with a lightweight WebKit profile by default: settings shared by all
+pages with JavaScript and plugins off, small memory caches, and one network
+access manager serving local icons from memory, so each image file is read
+once per process. Pass profile=None to keep the stock WebKit settings.
+
+With instrumentation of the stats module on, creating the application, setting
+the HTML code of a tab and loading it until loadFinished are timed.
 """
 
-from PyQt4.QtGui import QTabWidget, QApplication
-from PyQt4.QtWebKit import QWebView, QWebPage
-from PyQt4.QtCore import Qt, QSize, QPoint, QTimer
+import json
+import time
+from cgi import escape
+
+from PyQt4.QtGui import QTabWidget, QApplication, QWidget, QVBoxLayout
+from PyQt4.QtNetwork import QNetworkAccessManager, QNetworkReply, \
+    QNetworkRequest
+from PyQt4.QtWebKit import QWebView, QWebPage, QWebSettings
+from PyQt4.QtCore import Qt, QSize, QPoint, QTimer, QSocketNotifier, \
+    QThread, QIODevice, pyqtSignal
+
+import stats
+
+PLACEHOLDER = u"""<html><body style="font-family: sans-serif; color: gray">
+<p style="margin-top: 40%; text-align: center">{}</p>
+</body></html>"""
+
+# patch the loaded document to match new HTML code if it has the same
+# structure, returning false as soon as it differs
+PATCH = r"""(function (html) {
+    var doc = document.implementation.createHTMLDocument('');
+    doc.open();
+    doc.write(html);
+    doc.close();
+    function patch(old, node) {
+        if (old.nodeType !== node.nodeType || old.nodeName !== node.nodeName)
+            return false;
+        if (old.nodeType !== 1) {
+            if (old.nodeValue !== node.nodeValue)
+                old.nodeValue = node.nodeValue;
+            return true;
+        }
+        var i, attr;
+        for (i = 0; i < node.attributes.length; i++) {
+            attr = node.attributes[i];
+            if (old.getAttribute(attr.name) !== attr.value)
+                old.setAttribute(attr.name, attr.value);
+        }
+        for (i = old.attributes.length - 1; i >= 0; i--) {
+            if (!node.hasAttribute(old.attributes[i].name))
+                old.removeAttribute(old.attributes[i].name);
+        }
+        if (old.childNodes.length !== node.childNodes.length)
+            return false;
+        for (i = 0; i < node.childNodes.length; i++) {
+            if (!patch(old.childNodes[i], node.childNodes[i]))
+                return false;
+        }
+        return true;
+    }
+    return patch(document.body, doc.body);
+})(%s)"""
+
+
+class MemoryReply(QNetworkReply):
+
+    """ Finished network reply with content held in memory. """
+
+    def __init__(self, parent, request, content, kind):
+        """ Open reply and announce its content once back in the loop. """
+        super(MemoryReply, self).__init__(parent)
+        self.setRequest(request)
+        self.setUrl(request.url())
+        self.setOperation(QNetworkAccessManager.GetOperation)
+        self.setHeader(QNetworkRequest.ContentTypeHeader, kind)
+        self.setHeader(QNetworkRequest.ContentLengthHeader, len(content))
+        self.content = content
+        self.offset = 0
+        self.open(QIODevice.ReadOnly | QIODevice.Unbuffered)
+        QTimer.singleShot(0, self.ready)
+
+    def ready(self):
+        """ Emit signals of received content. """
+        self.setFinished(True)
+        self.readyRead.emit()
+        self.finished.emit()
+
+    def abort(self):
+        """ Nothing to abort. """
+        pass
+
+    def isSequential(self):
+        return True
+
+    def bytesAvailable(self):
+        return len(self.content) - self.offset + \
+            super(MemoryReply, self).bytesAvailable()
+
+    def readData(self, size):
+        """ Return next chunk of the content. """
+        chunk = self.content[self.offset:self.offset + size]
+        self.offset += len(chunk)
+        return chunk
+
+
+class IconManager(QNetworkAccessManager):
+
+    """
+    Network access manager serving local images from memory.
+
+    Image files are read once and kept in a store shared by all managers.
+    Other requests are handled as usual.
+    """
+
+    # file name: content
+    store = {}
+    KINDS = {'.png': 'image/png', '.gif': 'image/gif', '.jpg': 'image/jpeg'}
+
+    def createRequest(self, operation, request, device=None):
+        """ Return reply from the store for local images. """
+        url = request.url()
+        name = unicode(url.toLocalFile())
+        kind = self.KINDS.get(name[-4:].lower())
+        if operation == QNetworkAccessManager.GetOperation and kind and \
+                url.scheme() == 'file':
+            if name not in self.store:
+                try:
+                    with open(name, 'rb') as f:
+                        self.store[name] = f.read()
+                except (IOError, UnicodeError):
+                    self.store[name] = None
+            if self.store[name] is not None:
+                stats.count('icon.memory')
+                return MemoryReply(self, request, self.store[name], kind)
+        return super(IconManager, self).createRequest(operation, request,
+                                                      device)
+
+
+class Profile(object):
+
+    """
+    WebKit settings shared by all views, for static pages with local images.
+
+    JavaScript and plugins are off, except for patching pages. The memory
+    cache holds at most cache bytes, of which dead objects like images not
+    shown use at most dead, and no pages are kept for back navigation.
+    With icons, local images are served from memory by one manager.
+    """
+
+    def __init__(self, javascript=False, plugins=False, cache=4 << 20,
+                 dead=1 << 20, pages=0, icons=True):
+        """ Set the profile, applied by windows created with it. """
+        self.javascript = javascript
+        self.plugins = plugins
+        self.cache = cache
+        self.dead = dead
+        self.pages = pages
+        self.icons = icons
+        self.manager = None
+
+    def apply(self):
+        """ Set global WebKit settings. """
+        settings = QWebSettings.globalSettings()
+        settings.setAttribute(QWebSettings.JavascriptEnabled, self.javascript)
+        settings.setAttribute(QWebSettings.PluginsEnabled, self.plugins)
+        for attribute in (QWebSettings.JavaEnabled,
+                          QWebSettings.DnsPrefetchEnabled,
+                          QWebSettings.LocalStorageEnabled,
+                          QWebSettings.OfflineStorageDatabaseEnabled,
+                          QWebSettings.OfflineWebApplicationCacheEnabled):
+            settings.setAttribute(attribute, False)
+        QWebSettings.setObjectCacheCapacities(0, self.dead, self.cache)
+        QWebSettings.setMaximumPagesInCache(self.pages)
+        QWebSettings.setIconDatabasePath('')
+
+    def setup(self, view):
+        """ Make the view use the shared network access manager. """
+        if not self.icons:
+            return
+        if self.manager is None:
+            self.manager = IconManager()
+        view.page().setNetworkAccessManager(self.manager)
+
+
+LIGHT = Profile()
+
+
+class Tab(QWidget):
+
+    """
+    Tab page creating its webpage view only when needed.
+
+    Content is an HTML string or a callable returning it. A callable is
+    called once, when the view is first loaded. While the view shows a page
+    navigated to, e.g. by a link, new content is kept for when the tab is
+    shown again.
+    """
+
+    def __init__(self, content, resize, unscale, profile=None):
+        """ Prepare empty page, for views of the WebKit profile if given. """
+        super(Tab, self).__init__()
+        self.setFocusPolicy(Qt.NoFocus)
+        layout = QVBoxLayout(self)
+        layout.setContentsMargins(0, 0, 0, 0)
+        self.unscale = unscale
+        self.profile = profile
+        self.view = None
+        self.used = 0
+        # time the HTML code was set, until the view has loaded it
+        self.started = None
+        # the view shows a page navigated to instead of the content
+        self.away = False
+        self.setContent(content, resize)
+
+    def setContent(self, content, resize):
+        """ Set new content, reloading the view if it exists and shows it. """
+        self.content = content
+        self.resize = resize
+        self.html = None
+        if self.view is not None and not self.away:
+            self.view.setTextSizeMultiplier(resize)
+            self.present(self.view)
+
+    def patch(self, content, resize):
+        """
+        Set new content, patching the loaded view if possible.
+
+        Only content given as HTML code is patched, and only if the view is
+        loaded with the same size multiplier and the same page structure and
+        shows the content. Otherwise the content is set as by setContent.
+        """
+        if self.view is None or self.away or callable(content) or \
+                resize != self.resize:
+            return self.setContent(content, resize)
+        if content == self.render():
+            return
+        page = self.view.page()
+        # the patch script runs even if the profile turns JavaScript off
+        page.settings().setAttribute(QWebSettings.JavascriptEnabled, True)
+        try:
+            patched = page.mainFrame().evaluateJavaScript(
+                PATCH % json.dumps(content))
+        finally:
+            page.settings().resetAttribute(QWebSettings.JavascriptEnabled)
+        if hasattr(patched, 'toBool'):
+            # QVariant, unless the sip API version 2 is used
+            patched = patched.toBool()
+        if not patched:
+            stats.count('tab.reload')
+            return self.setContent(content, resize)
+        stats.count('tab.patch')
+        self.content = self.html = content
+
+    def render(self):
+        """ Return HTML code of the content. """
+        if self.html is None:
+            self.html = self.content() if callable(self.content) \
+                else self.content
+        return self.html
+
+    def load(self):
+        """ Create and load the view unless already done. """
+        if self.view is not None:
+            return self.view
+        view = QWebView()
+        if self.profile is not None:
+            self.profile.setup(view)
+        view.setFocusPolicy(Qt.NoFocus)
+        view.setTextSizeMultiplier(self.resize)
+        view.linkClicked.connect(self.unscale)
+        view.urlChanged.connect(self.navigated)
+        if stats.enabled():
+            view.loadFinished.connect(self.loaded)
+        self.layout().addWidget(view)
+        self.present(view)
+        if self.resize != 1:
+            view.page().setLinkDelegationPolicy(QWebPage.DelegateAllLinks)
+        self.view = view
+        return view
+
+    def present(self, view):
+        """ Set HTML code of the content in the view. """
+        html = self.render()
+        self.away = False
+        self.started = time.time()
+        with stats.timer('tab.html'):
+            view.setHtml(html)
+
+    def navigated(self, url):
+        """ Record if the view left the content for another page. """
+        self.away = url.toString() not in ('', 'about:blank')
+
+    def resume(self):
+        """ Show the content again if it was set while the view was away. """
+        if self.view is not None and self.away and self.html is None:
+            self.view.setTextSizeMultiplier(self.resize)
+            self.present(self.view)
+
+    def loaded(self, ok):
+        """ Record time from setting the HTML code until it was loaded. """
+        if self.started is not None:
+            stats.record('tab.load', time.time() - self.started)
+            self.started = None
+
+    def release(self):
+        """ Destroy the view, keeping the content. """
+        if self.view is not None:
+            self.view.deleteLater()
+            self.view = None
+
+
+class Loader(QThread):
+
+    """
+    Thread running a job which yields tabs.
+
+    Each tab is passed on by the tab signal together with its index. The done
+    signal gives the number of tabs, failed the error message.
+    """
+
+    tab = pyqtSignal(int, object)
+    done = pyqtSignal(int)
+    failed = pyqtSignal(object)
+
+    def __init__(self, job):
+        """ Prepare thread for a job, a function returning an iterable. """
+        super(Loader, self).__init__()
+        self.job = job
+
+    def run(self):
+        """ Run the job, emitting its tabs. """
+        import traceback
+
+        count = 0
+        try:
+            for count, tab in enumerate(self.job(), 1):
+                self.tab.emit(count - 1, tab)
+        except Exception as e:
+            traceback.print_exc()
+            self.failed.emit(u"{}: {}".format(type(e).__name__, e))
+        else:
+            self.done.emit(count)
 
 
 class QuickTabs(QTabWidget):
@@ -26,11 +378,18 @@ class QuickTabs(QTabWidget):
     Closes on loosing focus or any keybord action.
     """
 
-    def __init__(self, **kwargs):
+    # index of a tab filled in by a loader
+    filled = pyqtSignal(int)
+
+    def __init__(self, keep=3, prefetch=True, profile=LIGHT, **kwargs):
         """
         Initialize popup.
 
         Make sure it closes on loosing focus and keybord actions.
+        At most keep tabs hold a loaded view, the least recently shown ones
+        are released. With prefetch, the next tab is loaded after showing
+        a tab. Views use the WebKit profile, or stock settings if it is
+        None.
         """
         super(QuickTabs, self).__init__(**kwargs)
         from sys import platform
@@ -42,27 +401,123 @@ class QuickTabs(QTabWidget):
             self.setWindowFlags(Qt.FramelessWindowHint | Qt.Popup)
         self.setAttribute(Qt.WA_QuitOnClose)
         self.timeout = None
+        self.resident = False
+        self.keep = keep
+        self.prefetch = prefetch
+        self.used = 0
+        self.loader = None
+        self.live = False
+        self.profile = profile
+        if profile is not None:
+            profile.apply()
+        self.currentChanged.connect(self.select)
 
     def addTabs(self, tabs):
         """
         Add tabs to the popup.
 
-        Each tab is given as a tuple (html, name, resize). The last parameter
-        indicates if the text should be rescaled.
+        Each tab is given as a tuple (html, name, resize). The html can also
+        be a callable returning HTML code, called when the tab is first
+        shown. The last parameter indicates if the text should be rescaled.
 
         Tabs should not grab focus for main window to close on loosing focus.
         """
         for html, name, resize in tabs:
-            tab = QWebView()
-            tab.setFocusPolicy(Qt.NoFocus)
-            if resize != 1:
-                tab.setTextSizeMultiplier(resize)
-                tab.linkClicked.connect(self.unscale)
+            tab = Tab(html, resize, self.unscale, self.profile)
             self.addTab(tab, name)
-            tab.setHtml(html)
-            if resize != 1:
-                tab.page().setLinkDelegationPolicy(QWebPage.DelegateAllLinks)
         tab.parent().setFocusPolicy(Qt.NoFocus)
+        self.select(self.currentIndex())
+
+    def setTabs(self, tabs):
+        """
+        Replace content of all tabs.
+
+        Tabs are given as in addTabs. Existing tabs are reused, missing ones
+        are added and superfluous ones removed.
+        """
+        for index, (html, name, resize) in enumerate(tabs):
+            if index >= self.count():
+                self.addTabs(tabs[index:])
+                break
+            self.setTabText(index, name)
+            self.widget(index).setContent(html, resize)
+        self.trim(len(tabs))
+
+    def loadTabs(self, job, message="Loading...", live=False):
+        """
+        Fill tabs from a job run in a background thread.
+
+        The job is a function returning an iterable of tabs given as in
+        addTabs, rendering each of them when it is asked for the next one.
+        Until the first tab is ready, an empty window shows a placeholder
+        with the message. Existing tabs are replaced one by one, superfluous
+        ones removed at the end. If the job yields no tabs, the current ones
+        are kept. With live, loaded tabs of the same name are patched rather
+        than reloaded. Returns False if a job is still running.
+        """
+        if self.loader is not None and self.loader.isRunning():
+            return False
+        self.live = live
+        if not self.count():
+            self.addTabs([(PLACEHOLDER.format(escape(message)), message, 1)])
+        self.loader = Loader(job)
+        self.loader.tab.connect(self.fill)
+        self.loader.done.connect(self.trim)
+        self.loader.failed.connect(self.fail)
+        self.loader.start()
+        return True
+
+    def fill(self, index, tab):
+        """ Set content of a tab produced by a loader. """
+        html, name, resize = tab
+        if index < self.count() and self.live and \
+                self.tabText(index) == name:
+            self.widget(index).patch(html, resize)
+        elif index < self.count():
+            self.setTabText(index, name)
+            self.widget(index).setContent(html, resize)
+        else:
+            self.addTabs([tab])
+        self.filled.emit(index)
+
+    def trim(self, count):
+        """ Remove tabs past the given count, unless it is zero. """
+        while count and self.count() > count:
+            tab = self.widget(count)
+            self.removeTab(count)
+            tab.release()
+            tab.deleteLater()
+
+    def fail(self, message):
+        """ Show an error message of a loader in the current tab. """
+        html = PLACEHOLDER.format(escape(message))
+        self.currentWidget().setContent(html, 1)
+
+    def select(self, index):
+        """ Load the shown tab, then prefetch the next one when idle. """
+        if index < 0:
+            return
+        self.load(index)
+        if self.prefetch and index + 1 < self.count():
+            QTimer.singleShot(0, lambda: self.load(index + 1, False))
+
+    def load(self, index, shown=True):
+        """ Load a tab and release views of least recently shown tabs. """
+        tab = self.widget(index)
+        if tab is None:
+            return
+        if shown or not tab.used:
+            self.used += 1
+            tab.used = self.used
+        tab.load()
+        if shown:
+            tab.resume()
+        loaded = sorted((t for t in map(self.widget, range(self.count()))
+                         if t.view is not None), key=lambda t: t.used)
+        current = self.currentWidget()
+        for tab in loaded[:max(0, len(loaded) - self.keep)]:
+            if tab is not current:
+                tab.release()
 
     def keyPressEvent(self, e):
         """
@@ -85,26 +540,93 @@ class QuickTabs(QTabWidget):
         """ Close window on any keypress. """
         self.close()
 
+    def closeEvent(self, e):
+        """ Hide instead of closing if resident. """
+        if not self.resident:
+            return super(QuickTabs, self).closeEvent(e)
+        e.ignore()
+        self.hide()
+        if self.timeout:
+            self.timer.stop()
+
+    def center(self):
+        """ Move window to the middle of the screen. """
+        rect = QApplication.desktop().screenGeometry()
+        x = (rect.width() - self.width()) / 2
+        y = (rect.height() - self.height()) / 2
+        self.move(QPoint(x, y))
+
+    def popup(self):
+        """ Show window in the middle of the screen and restart timer. """
+        self.center()
+        self.show()
+        self.raise_()
+        self.activateWindow()
+        if self.timeout:
+            self.timer.start(self.timeout * 1000)
+
+    def listen(self, callback=None):
+        """
+        Stay resident and pop up when SIGUSR1 is received.
+
+        Closing events only hide the window. The optional callback is called
+        right after the window is shown, e.g. to refresh its content.
+        """
+        import os
+        import fcntl
+        import signal
+
+        self.resident = True
+        QApplication.instance().setQuitOnLastWindowClosed(False)
+        # wake up Qt event loop through a pipe written by signal handler
+        read, write = os.pipe()
+        for fd in (read, write):
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        signal.set_wakeup_fd(write)
+        signal.signal(signal.SIGUSR1, lambda *args: None)
+
+        def wake():
+            try:
+                os.read(read, 64)
+            except OSError:
+                pass
+            self.popup()
+            if callback:
+                QTimer.singleShot(0, callback)
+
+        self.notifier = QSocketNotifier(read, QSocketNotifier.Read)
+        self.notifier.activated.connect(wake)
+
     def unscale(self, url):
         """ Remove scaling from a tab. """
-        self.currentWidget().load(url)
-        self.currentWidget().setTextSizeMultiplier(1)
+        tab = self.currentWidget()
+        view = tab.load()
+        # before the load starts, so that no update patches the new page
+        tab.away = True
+        view.load(url)
+        view.setTextSizeMultiplier(1)
 
     @classmethod
-    def App(cls, width, height, timeout=60):
-        """ Return application and created window. """
+    @stats.timed('qt.app')
+    def App(cls, width, height, timeout=60, show=True, profile=LIGHT):
+        """
+        Return application and created window.
+
+        The window stays hidden if show is False. Its views use the WebKit
+        profile, or stock settings if it is None.
+        """
         app = QApplication([])
-        win = QuickTabs()
+        win = QuickTabs(profile=profile)
         win.resize(QSize(width, height))
-        rect = QApplication.desktop().screenGeometry()
-        x = (rect.width() - win.width()) / 2
-        y = (rect.height() - win.height()) / 2
-        win.move(QPoint(x, y))
-        win.show()
-        win.raise_()
+        win.center()
+        if show:
+            win.show()
+            win.raise_()
         if timeout:
             timer = QTimer()
-            timer.start(timeout * 1000)
+            if show:
+                timer.start(timeout * 1000)
             timer.timeout.connect(win.close)
             win.timer = timer
         win.timeout = timeout
@@ -0,0 +1,406 @@
+#!/usr/bin/env python
+"""
+Quota-aware refresh scheduling.
+
+Weather Underground keys allow a limited number of calls per minute and per
+day. Quota counts the calls made by all processes in ~/.weather/.quota.json
+and throttles before a limit would be exceeded: a call waits for a free slot
+in the current minute, but never for the daily budget. Batch callers queue
+for the per-minute slot however long it takes and are refused only by the
+daily budget.
+
+Scheduler adapts the time to live of cached features per location. Locations
+with active alerts or changing conditions (fast pressure change, rising
+chance of precipitation) are refreshed more often, stable ones and those not
+viewed for a day less often. Each location records the calls per day it
+would make, and all intervals are stretched when their sum does not fit in
+the daily budget.
+
+Breaker stops calling a failing API for a cool-down period after a number of
+consecutive failures, again shared by all processes through the cache.
+
+Shared state is stored under names starting with a dot, which the keys of
+locations never do, so that no location shares its files or locks.
+
+Run as a script to simulate panel updates of many locations on recorded
+payloads, offline and in virtual time, and report the quota use.
+"""
+
+import json
+import time
+
+import model
+
+
+class QuotaExceeded(IOError):
+
+    """ API call not allowed by the quota. """
+
+
+class CircuitOpen(IOError):
+
+    """ API call not allowed while the API is failing. """
+
+
+class DeadlineExceeded(IOError):
+
+    """ API call not completed in time. """
+
+
+class APIError(IOError):
+
+    """ API call answered with an error instead of the data. """
+
+
+class Quota(object):
+
+    """
+    API calls, demands and views of locations shared through the cache.
+
+    Without a cache, the state is only kept in memory, e.g. for simulation.
+    The clock and sleep functions can be replaced to run in virtual time.
+    """
+
+    def __init__(self, cache=None, per_minute=10, per_day=500,
+                 clock=time.time, sleep=time.sleep, name='.quota'):
+        """ Set limits, clock, and the cache and name to keep state under. """
+        self.cache = cache
+        self.name = name
+        self.per_minute = per_minute
+        self.per_day = per_day
+        self.clock = clock
+        self.sleep = sleep
+        self.calls = []
+        self.views = {}
+        self.demands = {}
+
+    def load(self):
+        """ Read shared state, dropping calls and demands older than a day. """
+        if self.cache is not None:
+            text = self.cache.read(self.cache.path(self.name, '.json'))
+            try:
+                state = json.loads(text) if text else {}
+            except ValueError:
+                state = {}
+            self.calls = state.get('calls', [])
+            self.views = state.get('views', {})
+            self.demands = state.get('demands', {})
+        now = self.clock()
+        self.calls = [t for t in self.calls if t > now - 24 * 3600]
+        self.demands = dict((location, (t, demand)) for location, (t, demand)
+                            in self.demands.items() if t > now - 24 * 3600)
+
+    def save(self):
+        """ Write shared state. """
+        if self.cache is not None:
+            self.cache.write(self.cache.path(self.name, '.json'), json.dumps(
+                {'calls': self.calls, 'views': self.views,
+                 'demands': self.demands}))
+
+    def transaction(self):
+        """ Return context holding the lock of the shared state. """
+        if self.cache is None:
+            return Unlocked()
+        return self.cache.lock(self.name)
+
+    def used(self):
+        """ Return numbers of calls in the last minute and day. """
+        with self.transaction():
+            self.load()
+        now = self.clock()
+        return (sum(1 for t in self.calls if t > now - 60), len(self.calls))
+
+    def delay(self):
+        """ Return seconds until a call is allowed, given loaded calls. """
+        now = self.clock()
+        delays = [0]
+        minute = [t for t in self.calls if t > now - 60]
+        if len(minute) >= self.per_minute:
+            delays.append(minute[-self.per_minute] + 60 - now)
+        if len(self.calls) >= self.per_day:
+            delays.append(self.calls[-self.per_day] + 24 * 3600 - now)
+        return max(delays)
+
+    def acquire(self, timeout=0, location=None, demand=None, queue=False):
+        """
+        Record a call, waiting up to timeout seconds for a free slot.
+
+        Returns False without waiting if the slot is further away. With
+        queue, a slot of the per-minute limit is waited for however far
+        away, and only the daily budget refuses the call. The calls per day
+        the location would make unthrottled are recorded with the call.
+        """
+        deadline = self.clock() + timeout
+        while True:
+            with self.transaction():
+                self.load()
+                delay = self.delay()
+                if delay <= 0:
+                    self.calls.append(self.clock())
+                    if location is not None:
+                        self.demands[location] = (self.clock(), demand)
+                    self.save()
+                    return True
+                daily = len(self.calls) >= self.per_day
+            if self.clock() + delay > deadline and (daily or not queue):
+                return False
+            self.sleep(delay)
+
+    def pressure(self, target=0.8):
+        """
+        Return factor stretching refresh intervals, given loaded state.
+
+        Intervals are stretched so that the demands of all locations fit in
+        the target fraction of the daily budget, and stretched further as
+        the rest of the budget runs out.
+        """
+        total = sum(demand for t, demand in self.demands.values())
+        factor = max(1.0, total / (target * self.per_day))
+        left = 1.0 - float(len(self.calls)) / self.per_day
+        if left < 1.0 - target:
+            factor *= (1.0 - target) / max(left, 1.0 / 16)
+        return factor
+
+    def view(self, location):
+        """ Record that a location was shown, at most once an hour. """
+        # recorded by this instance, e.g. of a server, without reading
+        if self.views.get(location) > self.clock() - 3600:
+            return
+        self.load()
+        if self.views.get(location) > self.clock() - 3600:
+            return
+        with self.transaction():
+            self.load()
+            self.views[location] = self.clock()
+            self.save()
+
+    def viewed(self, location):
+        """ Return time the location was last shown, None if never. """
+        return self.views.get(location)
+
+
+class Unlocked(object):
+
+    """ Context without any locking. """
+
+    def __enter__(self):
+        return True
+
+    def __exit__(self, *args):
+        return False
+
+
+class Breaker(object):
+
+    """
+    Circuit breaker of API calls shared by processes through the cache.
+
+    After threshold consecutive failures the circuit opens and calls are
+    refused for cooldown seconds. Then a call is let through again and its
+    success closes the circuit, while its failure opens it once more.
+    """
+
+    def __init__(self, cache=None, name='.breaker', threshold=3, cooldown=300,
+                 clock=time.time):
+        """ Set the cache and name to store the state under and limits. """
+        self.cache = cache
+        self.name = name
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.clock = clock
+        self.failures = 0
+        self.opened = None
+
+    def load(self):
+        """ Read shared state. """
+        if self.cache is None:
+            return
+        text = self.cache.read(self.cache.path(self.name, '.json'))
+        try:
+            state = json.loads(text) if text else {}
+        except ValueError:
+            state = {}
+        self.failures = state.get('failures', 0)
+        self.opened = state.get('opened')
+
+    def save(self):
+        """ Write shared state. """
+        if self.cache is not None:
+            self.cache.write(self.cache.path(self.name, '.json'), json.dumps(
+                {'failures': self.failures, 'opened': self.opened}))
+
+    def allow(self):
+        """ Return if a call may be made now. """
+        self.load()
+        return self.opened is None or \
+            self.clock() >= self.opened + self.cooldown
+
+    def success(self):
+        """ Record a successful call, closing the circuit. """
+        if self.failures or self.opened is not None:
+            self.failures = 0
+            self.opened = None
+            self.save()
+
+    def failure(self):
+        """ Record a failed call, opening the circuit at the threshold. """
+        self.load()
+        self.failures += 1
+        if self.failures >= self.threshold:
+            self.opened = self.clock()
+        self.save()
+
+
+class Scheduler(object):
+
+    """ Adaptive refresh intervals for the locations sharing a quota. """
+
+    def __init__(self, quota, fast=0.5, slow=2.0, idle=24 * 60, change=2,
+                 rise=30):
+        """
+        Set interval factors.
+
+        Active locations get fast times the time to live, stable ones or
+        those not viewed for idle minutes slow times it. Conditions are
+        changing with pressure change of change hPa or rise of chance of
+        precipitation of rise percent in the next three hours.
+        """
+        self.quota = quota
+        self.fast = fast
+        self.slow = slow
+        self.idle = idle
+        self.change = change
+        self.rise = rise
+
+    def activity(self, data, hourly):
+        """ Return interval factor of weather data and its hourly series. """
+        if data.get('alerts'):
+            return self.fast
+        if hourly.size:
+            ahead = min(3, hourly.size - 1)
+            change = abs(hourly.pressure[ahead] - hourly.pressure[0])
+            rise = max(hourly.pop[:ahead + 1]) - hourly.pop[0]
+            if change >= self.change or rise >= self.rise:
+                return self.fast
+            if hourly.onset is None and hourly.trend == '0':
+                return self.slow
+        return 1.0
+
+    def interval(self, location, ttl, data, hourly, expire=None,
+                 stretch=True):
+        """
+        Return minutes to live of a feature for a location.
+
+        The time to live ttl is adapted to the weather data and its hourly
+        series, the last view of the location and, with stretch, the quota
+        use. The result is at least a minute and at most expire minutes.
+        """
+        factor = self.activity(data, hourly)
+        if stretch:
+            factor *= self.quota.pressure()
+        viewed = self.quota.viewed(location)
+        if viewed is None or viewed < self.quota.clock() - self.idle * 60:
+            factor *= self.slow
+        minutes = max(1.0, ttl * factor)
+        return minutes if expire is None else min(minutes, expire)
+
+    def demand(self, location, ttls, data, hourly):
+        """
+        Return API calls per day a location makes with unstretched intervals.
+
+        A call fetches all outdated features, so their shortest time to live
+        in ttls counts.
+        """
+        return 24 * 60.0 / min(self.interval(location, ttl, data, hourly,
+                                             stretch=False) for ttl in ttls)
+
+
+def simulate(payloads, locations, hours, per_minute, per_day, viewed, tick):
+    """
+    Simulate panels updating locations every tick minutes for hours.
+
+    Location i shows the recorded payload i modulo their number, the first
+    viewed locations are shown often. Returns a dictionary of statistics.
+    """
+    from weather import FEATURES
+
+    clock = [0.0]
+    quota = Quota(per_minute=per_minute, per_day=per_day,
+                  clock=lambda: clock[0])
+    scheduler = Scheduler(quota)
+    names = ['location{}'.format(i) for i in range(locations)]
+    data = [model.parse(payloads[i % len(payloads)]) for i in range(locations)]
+    series = [model.HourlySeries(d.get('hours', ())) for d in data]
+    fetched = [dict((feature, None) for feature in FEATURES)
+               for _ in range(locations)]
+    stats = {'calls': 0, 'throttled': 0, 'peak_minute': 0, 'fetches': {},
+             'demand': 0}
+    for minute in range(0, hours * 60, tick):
+        clock[0] = minute * 60.0
+        for name in names[:viewed]:
+            quota.views[name] = clock[0]
+        calls = 0
+        for i, name in enumerate(names):
+            quota.load()
+            pending = [feature for feature, last in fetched[i].items()
+                       if last is None or minute - last >= scheduler.interval(
+                           name, FEATURES[feature][1], data[i], series[i],
+                           12 * 60)]
+            if not pending:
+                continue
+            demand = scheduler.demand(name, [FEATURES[feature][1]
+                                             for feature in FEATURES],
+                                      data[i], series[i])
+            if not quota.acquire(0, name, demand):
+                stats['throttled'] += 1
+                continue
+            calls += 1
+            for feature in pending:
+                fetched[i][feature] = minute
+                stats['fetches'][feature] = \
+                    stats['fetches'].get(feature, 0) + 1
+        stats['calls'] += calls
+        stats['peak_minute'] = max(stats['peak_minute'], calls)
+    stats['demand'] = int(sum(demand for t, demand in quota.demands.values()))
+    return stats
+
+
+if __name__ == "__main__":
+    import argparse
+    import glob
+    import os
+
+    bench = os.path.join(os.path.split(os.path.abspath(__file__))[0],
+                         'bench', 'fixtures')
+    parser = argparse.ArgumentParser(
+        description='Simulate quota use of panel updates offline.')
+    parser.add_argument('payloads', type=str, nargs='*',
+                        default=sorted(glob.glob(bench + '/*.json')),
+                        help='recorded API responses')
+    parser.add_argument('-l', '--locations', type=int, default=10,
+                        help='number of locations')
+    parser.add_argument('-H', '--hours', type=int, default=24,
+                        help='simulated time')
+    parser.add_argument('-m', '--per-minute', type=int, default=10,
+                        help='calls allowed per minute')
+    parser.add_argument('-d', '--per-day', type=int, default=500,
+                        help='calls allowed per day')
+    parser.add_argument('-v', '--viewed', type=int, default=1,
+                        help='number of locations shown often')
+    parser.add_argument('-t', '--tick', type=int, default=1,
+                        help='minutes between panel updates')
+    args = parser.parse_args()
+
+    payloads = []
+    for name in args.payloads:
+        with open(name) as f:
+            payloads.append(json.load(f))
+    stats = simulate(payloads, args.locations, args.hours, args.per_minute,
+                     args.per_day, args.viewed, args.tick)
+    print 'locations: {}, hours: {}, quota: {}/minute {}/day'.format(
+        args.locations, args.hours, args.per_minute, args.per_day)
+    print 'unthrottled demand: {demand} calls per day'.format(**stats)
+    print 'calls: {calls}, throttled updates: {throttled}, ' \
+        'peak calls per minute: {peak_minute}'.format(**stats)
+    for feature, count in sorted(stats['fetches'].items()):
+        print '  {:<14} fetched {:6} times'.format(feature, count)
@@ -0,0 +1,342 @@
+#!/usr/bin/env python
+"""
+HTTP server of rendered weather pages for any location and scale.
+
+GET /NAME?q=QUERY&mult=SCALE&size=FONT returns the output of the renderer
+NAME (build_main, hours_large, days_large, txtdays, alerts or message, the
+panel XML) for the location QUERY, of at most 100 characters without control
+characters. mult defaults to 1 and size, used by the message only, to 12.
+GET /stats returns counters of the server as JSON. Pages refer to their icons
+under /icons, which serves the icon folders of the install and the scaled
+copies in ~/.weather/icons. Requests never change the click action script of
+the local panel.
+
+Requests are handled by a fixed pool of threads. Fetched locations and
+rendered pages are kept in memory, each in a mapping of bounded size dropping
+the least recently used entries. A location is checked against the cache in
+~/.weather at most every few seconds, and outdated data is fetched the usual
+way. Requests count as views of the location, so that the scheduler refreshes
+it like a location shown in a panel. Concurrent requests for the same
+location or page are coalesced: one of them fetches or renders while the
+others wait for its result, so many users asking for the same city cause one
+API call and one render.
+
+A location without data for a page gets 404, one that cannot be fetched 502
+(or 503 if the API quota is used up), and any other error 500.
+
+bench/loadtest.py measures requests per second and latency against the stub
+API.
+"""
+
+import BaseHTTPServer
+import json
+import os
+import re
+import threading
+import time
+import urlparse
+from collections import OrderedDict
+from copy import copy
+from httplib import HTTPException
+
+from schedule import QuotaExceeded
+from weather import PAGES, Weather
+
+RENDERERS = ('build_main', 'hours_large', 'days_large', 'txtdays', 'alerts',
+             'message')
+
+# icon URL paths: set/name.png of the install, width/set/name.png if scaled
+ICON = re.compile(r'/icons/(?:(\d+)/)?(png|png_white)/(\w+)\.png$')
+
+
+class LRU(object):
+
+    """ Thread safe mapping of bounded size, dropping least recently used. """
+
+    def __init__(self, size):
+        """ Set maximum number of entries. """
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """ Return value of the key, marking it used, or default. """
+        with self.lock:
+            try:
+                value = self.entries.pop(key)
+            except KeyError:
+                return default
+            self.entries[key] = value
+            return value
+
+    def put(self, key, value):
+        """ Set value of the key, dropping the oldest entries if full. """
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class Flights(object):
+
+    """
+    Calls in progress by key, shared by concurrent callers.
+
+    The first caller of a key runs the call, the others wait for it and get
+    the same result or exception.
+    """
+
+    def __init__(self):
+        """ Start without calls. """
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def run(self, key, func):
+        """ Return result of func, or of the same call in progress. """
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = {'done': threading.Event()}
+        if leader:
+            try:
+                call['result'] = func()
+            except Exception as e:
+                call['error'] = e
+            finally:
+                with self.lock:
+                    del self.calls[key]
+                call['done'].set()
+        else:
+            call['done'].wait()
+        if 'error' in call:
+            raise call['error']
+        return call['result']
+
+
+class PoolMixIn(object):
+
+    """ Handle requests in a fixed pool of worker threads. """
+
+    workers = 8
+
+    def start_workers(self):
+        """ Start the worker threads. """
+        import Queue
+
+        self.requests = Queue.Queue()
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self.work)
+            thread.daemon = True
+            thread.start()
+
+    def process_request(self, request, client_address):
+        """ Queue the request for a worker. """
+        self.requests.put((request, client_address))
+
+    def work(self):
+        """ Handle queued requests, forever. """
+        while True:
+            request, client_address = self.requests.get()
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    """ Answer page requests. """
+
+    def do_GET(self):
+        """ Send a rendered page or the counters. """
+        url = urlparse.urlsplit(self.path)
+        name = url.path.strip('/')
+        if name == 'stats':
+            return self.reply(200, json.dumps(self.server.counters),
+                              'application/json')
+        if name.startswith('icons/'):
+            icon = self.server.icon(url.path)
+            if icon is None:
+                return self.reply(404, 'Unknown icon: ' + name)
+            return self.reply(200, icon, 'image/png')
+        if name not in RENDERERS:
+            return self.reply(404, 'Unknown page: ' + name)
+        params = urlparse.parse_qs(url.query)
+        try:
+            query = params['q'][0]
+            if len(query) > 100 or any(c < ' ' for c in query):
+                raise ValueError("invalid location")
+            mult = float(params.get('mult', ['1'])[0])
+            size = int(params.get('size', ['12'])[0])
+            if not 0.25 <= mult <= 4 or not 4 <= size <= 72:
+                raise ValueError("mult or size out of range")
+        except (KeyError, ValueError) as e:
+            return self.reply(400, 'Bad request: {}'.format(e))
+        try:
+            page = self.server.page(query, name, mult, size)
+        except QuotaExceeded as e:
+            return self.reply(503, str(e))
+        except (IOError, ValueError, HTTPException) as e:
+            return self.reply(502, 'Weather not available: {}'.format(e))
+        except Exception:
+            # never leave the client without an answer
+            self.server.handle_error(self.request, self.client_address)
+            return self.reply(500, 'Internal error')
+        if page is None:
+            return self.reply(404, 'No weather data for ' + query)
+        self.reply(200, page, 'application/xml' if name == 'message'
+                   else 'text/html')
+
+    def reply(self, code, body, kind='text/plain'):
+        """ Send a complete response, of UTF-8 text unless an image. """
+        self.send_response(code)
+        if not kind.startswith('image/'):
+            kind += '; charset=utf-8'
+        self.send_header('Content-Type', kind)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        """ Keep quiet. """
+        pass
+
+
+class WeatherService(PoolMixIn, BaseHTTPServer.HTTPServer):
+
+    """ HTTP server with in-memory locations and pages. """
+
+    allow_reuse_address = True
+    # pending connections, enough for bursts of many dashboard users
+    request_queue_size = 128
+
+    def __init__(self, address, workers=8, locations=256, pages=1024,
+                 check=10, **options):
+        """
+        Bind the server and start its workers.
+
+        At most locations fetched locations and pages rendered pages are
+        kept. A location is checked for outdated data at most every check
+        seconds. Other options are passed on to Weather, with icon_root set
+        to the served icons.
+        """
+        BaseHTTPServer.HTTPServer.__init__(self, address, Handler)
+        self.path = os.path.split(os.path.abspath(__file__))[0]
+        self.home = os.path.expanduser('~') + '/.weather'
+        self.workers = workers
+        self.locations = LRU(locations)
+        self.pages = LRU(pages)
+        self.check = check
+        self.options = dict(options, icon_root='/icons')
+        self.flights = Flights()
+        self.counters = {'requests': 0, 'fetches': 0, 'renders': 0,
+                         'page_hits': 0}
+        self.lock = threading.Lock()
+        self.start_workers()
+
+    def count(self, name):
+        """ Increment a counter. """
+        with self.lock:
+            self.counters[name] += 1
+
+    def icon(self, path):
+        """ Return content of the icon at a URL path, or None if unknown. """
+        match = ICON.match(path)
+        if match is None:
+            return None
+        width, folder, name = match.groups()
+        if width:
+            file = '{}/icons/{}/{}/{}.png'.format(self.home, width, folder,
+                                                  name)
+        else:
+            file = '{}/{}/{}.png'.format(self.path, folder, name)
+        try:
+            with open(file, 'rb') as f:
+                return f.read()
+        except IOError:
+            return None
+
+    def location(self, query):
+        """ Return Weather of a query with data checked recently. """
+        entry = self.locations.get(query)
+        if entry is not None and entry[1] > time.time() - self.check:
+            return entry[0]
+
+        def fetch():
+            weather = entry[0] if entry else Weather(query, **self.options)
+            self.count('fetches')
+            weather.fetch()
+            self.locations.put(query, (weather, time.time()))
+            return weather
+        return self.flights.run(('location', query), fetch)
+
+    def page(self, query, name, mult, size):
+        """
+        Return encoded page of a renderer for a location and scale.
+
+        None is returned if the location has no data for the page.
+        """
+        self.count('requests')
+        weather = self.location(query)
+        weather.quota.view(weather.key)
+        # renderers run on a copy, which keeps its data while the location
+        # is refreshed, with its own scale
+        view = copy(weather)
+        if view.missing(view.data, PAGES[name]):
+            return None
+        view.mult, view.size = mult, size
+        key = (query, name, mult, size, view.stale,
+               tuple(view.digests.get(feature) for feature in PAGES[name]))
+        page = self.pages.get(key)
+        if page is not None:
+            self.count('page_hits')
+            return page
+
+        def render():
+            # rendered by a flight that ended since the lookup above
+            page = self.pages.get(key)
+            if page is not None:
+                return page
+            self.count('renders')
+            page = getattr(view, name)()
+            if isinstance(page, unicode):
+                page = page.encode('utf-8')
+            self.pages.put(key, page)
+            return page
+        return self.flights.run(('page',) + key, render)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Serve rendered weather pages over HTTP.')
+    parser.add_argument('-p', '--port', type=int, default=8080,
+                        help='port to listen on')
+    parser.add_argument('-b', '--bind', type=str, default='localhost',
+                        help='address to listen on')
+    parser.add_argument('-w', '--workers', type=int, default=8,
+                        help='number of worker threads')
+    parser.add_argument('-l', '--locations', type=int, default=256,
+                        help='locations kept in memory')
+    parser.add_argument('-P', '--pages', type=int, default=1024,
+                        help='rendered pages kept in memory')
+    parser.add_argument('-a', '--api', type=str, default=None,
+                        help='API root URL, e.g. of bench/stubserver.py')
+    args = parser.parse_args()
+
+    options = {'api': args.api} if args.api else {}
+    server = WeatherService((args.bind, args.port), args.workers,
+                            args.locations, args.pages, **options)
+    print 'Serving on http://{}:{}/'.format(args.bind, args.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
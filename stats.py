@@ -0,0 +1,138 @@
+"""
+Timers and counters of the phases of fetching and showing the weather.
+
+Instrumentation is off by default, then a timer is a shared do-nothing
+context and a count a single test, so it can stay in place everywhere.
+Functions can be timed as a whole by the timed decorator.
+
+Once enabled with a log file, each timed phase is appended to it as a line of
+JSON with the time, process id, phase name and duration in milliseconds,
+and at exit a summary line gives the number, total and longest duration of
+each phase together with all counters. Lines of several processes can go to
+the same file. Phase names are dotted, e.g. cache.read or render.message.
+"""
+
+import os
+import time
+from functools import wraps
+
+# log file object while enabled, None while off
+LOG = None
+LOCK = None
+TIMERS = {}
+COUNTERS = {}
+
+
+class Timer(object):
+
+    """ Context timing a phase. """
+
+    def __init__(self, name):
+        """ Set phase name. """
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        # failed phases, e.g. reads of missing files, are not recorded
+        if kind is None:
+            record(self.name, time.time() - self.start)
+        return False
+
+
+class Off(object):
+
+    """ Context doing nothing while instrumentation is off. """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+OFF = Off()
+
+
+def enable(path):
+    """ Start appending phases to the log file and a summary at exit. """
+    global LOG, LOCK
+    import atexit
+    import threading
+
+    if LOG is not None:
+        return
+    LOCK = threading.Lock()
+    LOG = open(path, 'a')
+    atexit.register(summary)
+
+
+def enabled():
+    """ Return if instrumentation is on. """
+    return LOG is not None
+
+
+def timer(name):
+    """ Return context timing the named phase. """
+    if LOG is None:
+        return OFF
+    return Timer(name)
+
+
+def timed(name):
+    """ Return decorator timing each call of a function as the phase. """
+    def decorate(func):
+        @wraps(func)
+        def call(*args, **kwargs):
+            if LOG is None:
+                return func(*args, **kwargs)
+            with Timer(name):
+                return func(*args, **kwargs)
+        return call
+    return decorate
+
+
+def record(name, seconds):
+    """ Record a phase measured by the caller, e.g. across Qt events. """
+    if LOG is None:
+        return
+    import json
+
+    with LOCK:
+        times, total, longest = TIMERS.get(name, (0, 0.0, 0.0))
+        TIMERS[name] = (times + 1, total + seconds, max(longest, seconds))
+        write(json.dumps({'time': round(time.time(), 3), 'pid': os.getpid(),
+                          'phase': name, 'ms': round(seconds * 1000, 3)}))
+
+
+def count(name, n=1):
+    """ Add n to the named counter. """
+    if LOG is None:
+        return
+    with LOCK:
+        COUNTERS[name] = COUNTERS.get(name, 0) + n
+
+
+def summary():
+    """ Append totals of phases and counters to the log. """
+    import json
+
+    if LOG is None:
+        return
+    with LOCK:
+        write(json.dumps({
+            'time': round(time.time(), 3), 'pid': os.getpid(),
+            'phases': dict((name, {'count': times,
+                                   'ms': round(total * 1000, 3),
+                                   'max_ms': round(longest * 1000, 3)})
+                           for name, (times, total, longest)
+                           in TIMERS.items()),
+            'counters': COUNTERS}, sort_keys=True))
+
+
+def write(line):
+    """ Append a line to the log, holding the lock. """
+    LOG.write(line + '\n')
+    LOG.flush()
@@ -0,0 +1,76 @@
+"""
+Compiled HTML templates.
+
+Templates use str.format syntax with named fields. Each template is parsed
+once, when created, and compiled into a function filling a plain unicode %s
+string with the fields, so repeated cells of a page cost no field lookup by
+name or format spec parsing.
+
+Fields given as None, e.g. values missing from the API response, are shown
+as MISSING rather than as the text None.
+
+Fields which stay the same for all cells of a page, like icon sizes, can be
+bound in advance. Binding gives a new template with these values moved into
+the literal text, and is remembered for the same values.
+
+Whole pages are built by collecting rendered pieces in a list and joining them
+at the end.
+"""
+
+from string import Formatter
+
+# shown for fields given as None: an en dash, valid in HTML and XML alike
+MISSING = u'\u2013'
+
+
+class Template(object):
+
+    """ Format string compiled once into a rendering function. """
+
+    def __init__(self, text):
+        """ Parse and compile template text. """
+        self.text = text
+        self.parts = []
+        for literal, field, spec, conversion in Formatter().parse(text):
+            if field == '' or conversion or \
+                    (field and not field.replace('_', '').isalnum()):
+                raise ValueError("Only named fields are supported: " + text)
+            self.parts.append((literal, field, spec or ''))
+        text = []
+        values = []
+        for literal, field, spec in self.parts:
+            text.append(literal.replace('%', '%%'))
+            if field is not None:
+                text.append('%s')
+                value = 'fields[{!r}]'.format(field)
+                if spec:
+                    value = '_format({}, {!r})'.format(value, spec)
+                values.append('({} if fields[{!r}] is not None else '
+                              '_missing)'.format(value, field))
+        self.render = eval("lambda **fields: _text % ({})".format(
+            ''.join(value + ', ' for value in values)),
+            {'_text': u''.join(text), '_format': format,
+             '_missing': MISSING})
+        self.bound = {}
+
+    def bind(self, **fields):
+        """ Return template with some fields replaced by values. """
+        key = tuple(sorted(fields.items()))
+        if key not in self.bound:
+            text = []
+            for literal, field, spec in self.parts:
+                text.append(escape(literal))
+                if field in fields:
+                    value = fields[field]
+                    text.append(MISSING if value is None
+                                else escape(format(value, spec)))
+                elif field is not None:
+                    text.append('{' + field + (':' + spec if spec else '') +
+                                '}')
+            self.bound[key] = Template(''.join(text))
+        return self.bound[key]
+
+
+def escape(text):
+    """ Escape braces for format strings. """
+    return text.replace('{', '{{').replace('}', '}}')
@@ -10,38 +10,42 @@ Applet for Cinnamon to show current conditions. Click action is also supplied as
 part of the message so that clicking on the Applet opens the weather App.
 
 In either case the fetched data is stored in ~/.weather folder and reused if
-a preset time did not elapse since last fetch. That time can be changed using
-min argument to Weather constructor. This setup prevents too many queries being
-sent to WU API.
+a preset time did not elapse since last fetch. Each WU feature (conditions,
+hourly, forecast10day, alerts) is stored separately with its own time, and only
+the outdated ones are fetched. The times can be changed using ttl argument to
+Weather constructor. Older data is still used while a fresh copy is fetched in
+the background, unless it is older than the expire argument. The data is kept
+in the compact model of the model module, which is also what the cache stores.
+This setup prevents too many queries being sent to WU API.
 
 Finally, an API key is needed and default key can be set below.
 """
 
-import urllib2
+import sys
+
+if __name__ == "__main__":
+    # panel updates answered by a running daemon skip the imports below
+    import panel
+
+    ANSWER = panel.options(sys.argv[1:])
+    if ANSWER and panel.answer(**ANSWER):
+        sys.exit()
+
 import json
+import hashlib
 import os
 import re
-import time
 
-# parse arguments
-import argparse
+import model
+import stats
+from cache import Cache, SERIALIZERS
+from schedule import APIError, Breaker, CircuitOpen, DeadlineExceeded, \
+    Quota, QuotaExceeded, Scheduler
+from template import Template
 
-parser = argparse.ArgumentParser(description='Fetch weather and show results.')
-parser.add_argument('location', type=str, help='weather location')
-parser.add_argument('-m', '--mult', type=float, default=1.0,
-                    help='resize GUI by the given factor')
-parser.add_argument('-k', '--key', type=str, default="",
-                    help='Weather Underground API key')
-parser.add_argument('-u', '--update', action='store_true', default=False,
-                    help='update files without showing GUI')
-parser.add_argument('-s', '--size', type=int, default=12,
-                    help='font size for the message string')
-
-args = parser.parse_args()
-
-QUERY = args.location
-MULT = args.mult
-API_KEY = args.key
+# default API key, used if none is given or saved
+API_KEY = ""
+API_ROOT = "http://api.wunderground.com/api"
 
 # 'icon' field contains a name
 # 'icon_url' and/or 'icon' may have nt_ for night: use second option
@@ -82,371 +86,1011 @@ ICON = {'chanceflurries': ['41', '46'],
         'WU': 'WU',
         }
 
+# icons without a white version
+LOGOS = ('WU',)
+
+ICONS = {}
+
+
+def file_url(name):
+    """
+    Return the file URL of a file name.
+
+    Names with other than plain ASCII characters are percent-encoded, so
+    that pages are ASCII whatever the install and home folders are called.
+    """
+    if re.match(r'[\w./-]*$', name):
+        return "file:" + name
+    from urllib import quote
+
+    if isinstance(name, unicode):
+        name = name.encode('utf-8')
+    return "file:" + quote(name)
+
+
+def file_name(url):
+    """ Return the file name of a file URL given by file_url. """
+    name = url[5:]
+    if '%' not in name:
+        return name
+    from urllib import unquote
+
+    return unquote(name)
+
+
+def text(name):
+    """
+    Return a file name as unicode, for rendered output.
+
+    Names are decoded by the file system encoding, or as UTF-8 if that is
+    ASCII, e.g. under the C locale.
+    """
+    if isinstance(name, unicode):
+        return name
+    try:
+        return name.decode(sys.getfilesystemencoding() or 'utf-8')
+    except UnicodeDecodeError:
+        return name.decode('utf-8', 'replace')
+
+
+def icon_table(path):
+    """
+    Return the ICON mapping compiled into a table of icon URLs.
+
+    Table keys are (name or fctcode, night, white) and it is shared by all
+    instances using icons in path, so that resolved icons can be memoized in
+    it. Raises RuntimeError if a mapped icon file is missing.
+    """
+    if path in ICONS:
+        return ICONS[path]
+    table = {}
+    missing = []
+    for name, icon in ICON.items() + [('na', 'na')]:
+        day, night = icon if isinstance(icon, list) else (icon, icon)
+        for white in (False, True):
+            folder = 'png_white' if white and name not in LOGOS else 'png'
+            for dark, number in ((False, day), (True, night)):
+                file = "{}/{}/{}.png".format(path, folder, number)
+                if not os.path.exists(file):
+                    missing.append(file)
+                table[name, dark, white] = file_url(file)
+    if missing:
+        raise RuntimeError("Missing icons: " + ", ".join(sorted(set(missing))))
+    ICONS[path] = table
+    return table
+
+
+def scaled(file, width, folder):
+    """
+    Return name of a copy of the icon file scaled to width.
+
+    Copies are made once and kept in folder, as width/set/name.png. The
+    original file is returned if it cannot be scaled, e.g. without PyQt4.
+    """
+    head, name = os.path.split(file)
+    target = "{}/{}/{}/{}".format(folder, width, os.path.basename(head), name)
+    if os.path.exists(target):
+        return target
+    try:
+        from PyQt4.QtCore import Qt
+        from PyQt4.QtGui import QImage
+    except ImportError:
+        return file
+    import tempfile
+
+    image = QImage(file)
+    if image.isNull():
+        return file
+    try:
+        os.makedirs(os.path.dirname(target))
+    except OSError:
+        pass
+    # unique per thread too, e.g. of the service scaling the same icon
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(target), suffix='.tmp')
+    os.close(fd)
+    if not image.scaledToWidth(width, Qt.SmoothTransformation) \
+            .save(tmp, "PNG"):
+        os.unlink(tmp)
+        return file
+    os.rename(tmp, target)
+    return target
+
+
+# separately cached WU features: (model data keys, minutes to live)
+FEATURES = {'alerts': (('alerts',), 5),
+            'conditions': (('current',), 2),
+            'forecast10day': (('days', 'texts'), 3 * 60),
+            'hourly': (('hours',), 30),
+            }
+
+# features used by each renderer whose output is cached
+PAGES = {'alerts': ('alerts',),
+         'build_main': ('alerts', 'conditions', 'forecast10day', 'hourly'),
+         'days_large': ('forecast10day',),
+         'hours_large': ('hourly',),
+         'message': ('conditions', 'hourly'),
+         'txtdays': ('forecast10day',),
+         }
+
 TREND = {'+': '&nearr;',
          '-': '&searr;',
          '0': ''
          }
 
 
+def download(url, pool=None, connect=None, read=None):
+    """
+    Return the body of a GET request for url.
+
+    If a pool dictionary is given, keep-alive connections are stored in it
+    per host and reused by subsequent calls with the same pool. A connection
+    dropped by the server is reopened once. Optional connect and read
+    timeouts are in seconds, the read timeout applies to each socket read.
+    """
+    import httplib
+    import socket
+    import urllib2
+    import urlparse
+
+    if pool is None:
+        pool = {}
+        try:
+            return download(url, pool, connect, read)
+        finally:
+            for conn in pool.values():
+                conn.close()
+    parts = urlparse.urlsplit(url)
+    path = parts.path + ('?' + parts.query if parts.query else '')
+    for retry in (False, True):
+        conn = pool.get(parts.netloc)
+        reused = conn is not None
+        if not reused:
+            conn = pool[parts.netloc] = httplib.HTTPConnection(
+                parts.netloc, timeout=connect)
+        try:
+            if conn.sock is None:
+                conn.connect()
+            conn.sock.settimeout(read)
+            conn.request('GET', path)
+            res = conn.getresponse()
+            body = res.read()
+        except (httplib.HTTPException, socket.error):
+            conn.close()
+            del pool[parts.netloc]
+            if retry or not reused:
+                raise
+            continue
+        if res.status != 200:
+            raise urllib2.HTTPError(url, res.status, res.reason, res.msg, None)
+        return body
+
+
 class Weather(object):
 
     """ Wrapper of the Weather Underground API. """
 
     def __init__(self, query, **options):
-        """ Initialize the API query URL. """
-        global API_KEY
+        """
+        Initialize the API query URL.
 
+        Options: key (API key, saved for later use), mult (GUI scale),
+        size (message font size), api (API root URL), ttl (minutes to live
+        per feature), expire (minutes to hard expiry), evict (days),
+        format (cache format, one of SERIALIZERS), wait (seconds to wait
+        for another process fetching the same location or for the API
+        quota), quota (API calls allowed per minute and per day), queue
+        (wait for the per-minute quota however long, for batches), deadline
+        (seconds a refresh may take in all, after the quota wait when
+        queued), timeout (connect and read timeouts of an API call in
+        seconds), detach (refresh stale data in a detached process
+        instead of a thread, for short-lived processes) and icon_root (URL
+        the icon folders are served under, instead of file URLs).
+        """
         self.path = os.path.split(os.path.abspath(__file__))[0]
+        self.icons = icon_table(self.path)
         self.home = os.path.expanduser('~') + '/.weather'
         try:
             os.mkdir(self.home)
-        except:
+        except OSError:
             pass
-        if not API_KEY:
+        self.api_key = options.get('key') or API_KEY
+        if not self.api_key:
             try:
                 with open(self.home+'/API.key', 'r') as f:
-                    API_KEY = f.readline().strip()
-            except:
+                    self.api_key = f.readline().strip()
+            except IOError:
                 raise RuntimeError("No API key provided or saved.")
-        else:
+        elif options.get('key'):
             with open(self.home+'/API.key', 'w') as f:
-                print >>f, API_KEY
+                print >>f, self.api_key
 
-        features = "alerts/conditions/forecast10day/hourly"
-        settings = "bestfct:1"
-        fmt = "json"
-        self.url = "http://api.wunderground.com/api/{}/{}/{}/q/{}.{}" \
-            .format(API_KEY, features, settings, query, fmt)
-        print self.url
+        self.query = query
+        self.mult = options.get('mult', 1.0)
+        self.size = options.get('size', 12)
+        self.api = options.get('api', API_ROOT)
+        self.format = options.get('format', 'marshal')
+        self.wait = options.get('wait', 10.0)
+        self.queue = options.get('queue', False)
+        self.detach = options.get('detach', False)
+        self.icon_root = options.get('icon_root')
+        self.deadline = options.get('deadline', 15.0)
+        self.timeout = options.get('timeout', (3.0, 5.0))
+        # first and longest pause between attempts of an API call
+        self.backoff = (0.5, 4.0)
         self.data = {}
-        if 'min' in options:
-            self.min = options['min']
-        else:
-            self.min = 5
-        self.old(self.min)
+        # digests of the cached features the data in use was made of
+        self.digests = {}
+        self.hourly = model.HourlySeries(())
+        self.daily = model.DailySeries(())
+        self.ttl = dict((feature, FEATURES[feature][1])
+                        for feature in FEATURES)
+        self.ttl.update(options.get('ttl', {}))
+        self.cache = Cache(self.home, min(self.ttl.values()),
+                           options.get('expire', 12 * 60),
+                           options.get('evict', 30), self.format)
+        self.quota = Quota(self.cache, *options.get('quota', (10, 500)))
+        self.scheduler = Scheduler(self.quota)
+        self.breaker = Breaker(self.cache)
         self.alert = False
-        self.file = self.home + '/{}.json' \
-            .format(re.sub(r'\W', '_', query))
+        # reason why data older than its time to live is shown, if any
+        self.stale = None
+        self.key = re.sub(r'\W', '_', query)
+        self.pidfile = self.home + '/{}.pid'.format(self.key)
+        # click action script of the panel, written by clickaction()
+        self.action = self.home + '/clickaction'
+        self.refreshing = None
+        self.migrate()
+
+    def migrate(self):
+        """
+        Split the response cached whole by older versions into features.
 
-    def old(self, min=5):
-        """ Remove saved weather if older than a number of minutes. """
+        Older versions kept the complete API response of a location in
+        <key>.json. The features found in it are stored as entries with its
+        times, unless they are cached already, and the file is removed. A
+        file that does not parse as an API response is left alone.
+        """
+        name = '{}/{}.json'.format(self.home, self.key)
+        try:
+            with open(name, 'r') as f:
+                text = f.read()
+            times = os.path.getatime(name), os.path.getmtime(name)
+        except (IOError, OSError):
+            return
         try:
-            modified = os.path.getmtime(self.file)
-            current = time.time()
-            if current-modified > min * 60:
-                os.unlink(self.file)
-        except:
+            raw = json.loads(text)
+            if 'response' not in raw:
+                return
+            data = model.parse(raw)
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return
+        for feature, (sections, ttl) in FEATURES.items():
+            key = self.key + '.' + feature
+            part = dict((section, data[section]) for section in sections
+                        if section in data)
+            if part and self.cache.state(key) == 'missing':
+                self.cache.store(key, model.dump(part))
+                os.utime(self.cache.path(key), times)
+        try:
+            os.unlink(name)
+        except OSError:
             pass
 
-    def fetch(self):
-        """ Get the weather data. """
-        self.old(self.min)
-        try:
-            with open(self.file, 'r') as f:
-                self.data = json.load(f)
-        except:
-            res = urllib2.urlopen(self.url).read()
-            self.data = json.loads(res)
-            with open(self.file, 'w') as f:
-                print >>f, json.dumps(self.data, sort_keys=True, indent=4,
-                                      separators=(',', ': '))
-        if 'alerts' in self.data and self.data["alerts"]:
-            self.alert = True
-
-    def icon(self, name, url, number="0", white=False):
-        """ Get appropriate icon from ICON dictionary. """
-        night = '/nt_' in url or 'nt_' in name
-        name = name.replace('nt_', '')
-        if number in ICON:
-            icon = ICON[number]
-        elif name in ICON:
-            icon = ICON[name]
-        else:
-            icon = 'na'
-        # pick day/night version if exist
-        if isinstance(icon, list):
-            if night:
-                icon = icon[1]
+    def url(self, features):
+        """ Return the API query URL for a list of features. """
+        import urllib
+
+        settings = "bestfct:1"
+        fmt = "json"
+        query = self.query
+        if isinstance(query, unicode):
+            query = query.encode('utf-8')
+        return "{}/{}/{}/{}/q/{}.{}" \
+            .format(self.api, self.api_key, '/'.join(sorted(features)),
+                    settings, urllib.quote(query, safe='/'), fmt)
+
+    def interval(self, feature):
+        """
+        Return minutes to live of a feature, adapted by the scheduler.
+
+        Calls made against the quota should be loaded.
+        """
+        return self.scheduler.interval(self.key, self.ttl[feature],
+                                       self.data, self.hourly,
+                                       self.cache.expire)
+
+    def outdated(self):
+        """ Return features which are not fresh in the cache. """
+        self.quota.load()
+        return [feature for feature in FEATURES
+                if self.cache.state(self.key + '.' + feature,
+                                    self.interval(feature)) != 'fresh']
+
+    @stats.timed('fetch')
+    def fetch(self, pool=None, background=True):
+        """
+        Get the weather data.
+
+        Each feature is cached separately with its own time to live, adapted
+        to the data and the API quota use by the scheduler. Usable
+        cached data is returned at once. Stale features are fetched in a
+        background thread, unless background is False. Only missing or
+        expired features make the call wait for the network, in which case
+        stale features are fetched in the same request. Expired data is
+        still shown, marked stale, if it cannot be fetched in time.
+        Optional pool of keep-alive connections is passed on to download.
+        """
+        data = {}
+        loaded = []
+        missing = []
+        for feature in FEATURES:
+            key = self.key + '.' + feature
+            expired = self.cache.state(key) == 'expired'
+            part = self.load(key)
+            if part:
+                data.update(part)
+            if expired or not part:
+                missing.append(feature)
             else:
-                icon = icon[0]
-        if white:
-            return "file:{}/png_white/{}.png".format(self.path, icon)
+                loaded.append(feature)
+        self.update(data)
+        self.quota.load()
+        stale = [feature for feature in loaded
+                 if self.cache.state(self.key + '.' + feature,
+                                     self.interval(feature)) == 'stale']
+        if missing or (stale and not background):
+            self.refresh(missing + stale, pool)
+        elif stale:
+            self.revalidate(stale)
         else:
-            return "file:{}/png/{}.png".format(self.path, icon)
+            self.stale = None
+
+    def refresh(self, features=FEATURES, pool=None):
+        """
+        Download and cache the given features in a single API call.
+
+        Only one process or thread refreshes a location at a time. Features
+        found fresh in the cache once it is our turn, e.g. refreshed by the
+        process we waited for, are loaded instead of downloaded. If the wait
+        times out, older data in use is kept and only features without data
+        are downloaded. The call then waits for the API quota and is retried
+        on failures, all within the deadline. With the queue option the
+        per-minute quota is waited for however long, and the deadline
+        starts once the call is allowed. If the features cannot be
+        fetched, older data in use is kept and marked stale with the reason
+        in the stale attribute, while features without any data raise the
+        error, e.g. QuotaExceeded, CircuitOpen, DeadlineExceeded or APIError
+        for an unknown location. The new data sections are merged into the
+        current data.
+        """
+        import time
+        from httplib import HTTPException
+
+        deadline = time.time() + self.deadline
+        left = lambda: max(0, min(self.wait, deadline - time.time()))
+        stale = None
+        with self.cache.lock(self.key, left()) as locked:
+            data = dict(self.data)
+            pending = []
+            for feature in features:
+                key = self.key + '.' + feature
+                part = None
+                if locked:
+                    self.quota.load()
+                    if self.cache.state(key,
+                                        self.interval(feature)) == 'fresh':
+                        part = self.load(key)
+                elif not self.missing(data, [feature]):
+                    part = {}
+                    if self.cache.state(key) == 'expired':
+                        stale = "Another process is fetching the data."
+                if part is None:
+                    pending.append(feature)
+                else:
+                    data.update(part)
+            demand = self.scheduler.demand(self.key, self.ttl.values(),
+                                           self.data, self.hourly)
+            if pending and not self.quota.acquire(left(), self.key, demand,
+                                                  self.queue):
+                missing = self.missing(data, pending)
+                self.update(data)
+                if missing:
+                    raise QuotaExceeded("API quota used up, cannot fetch " +
+                                        ', '.join(missing))
+                stale = "API quota used up."
+                pending = []
+            if pending:
+                if self.queue:
+                    deadline = max(deadline, time.time() + self.deadline)
+                try:
+                    res = self.call(self.url(pending), pool, deadline,
+                                    lambda body: self.parse(body, pending))
+                except (IOError, ValueError, HTTPException) as e:
+                    self.update(data)
+                    if self.missing(data, pending):
+                        raise
+                    stale = "{}: {}".format(type(e).__name__, e)
+                    res = {}
+                for feature in pending:
+                    part = dict((section, res[section])
+                                for section in FEATURES[feature][0]
+                                if section in res)
+                    if part:
+                        self.cache.store(self.key + '.' + feature,
+                                         model.dump(part))
+                        data.update(part)
+                self.cache.prune()
+        self.stale = stale
+        self.update(data)
+
+    def missing(self, data, features):
+        """ Return those of the features without any sections in data. """
+        return [feature for feature in features
+                if not all(section in data
+                           for section in FEATURES[feature][0])]
+
+    def parse(self, body, features):
+        """
+        Return model data of an API response with the given features.
+
+        Raises APIError for an error response, e.g. an unknown location, or
+        a response without the sections of the features.
+        """
+        with stats.timer('parse'):
+            response = json.loads(body)
+            data = model.parse(response)
+        error = response.get('response', {}).get('error')
+        if error:
+            raise APIError(error.get('description') or error.get('type'))
+        missing = self.missing(data, features)
+        if missing:
+            raise APIError("API response without " + ', '.join(missing))
+        return data
+
+    def call(self, url, pool=None, deadline=None, parse=None):
+        """
+        Return the body of an API call, retrying failures until deadline.
+
+        The deadline is a time.time() value. Each attempt has the connect
+        and read timeouts, cut to the time left. A failed attempt is retried
+        after an exponentially growing pause with full jitter, unless the
+        pause would end after the deadline, in which case DeadlineExceeded
+        is raised. Client errors (HTTP status below 500 and invalid URLs)
+        are raised at once. Other failures, i.e. timeouts, connection errors
+        and server errors, are counted by the circuit breaker, and while it
+        is open no attempt is made and CircuitOpen is raised. With parse,
+        its result for the body is returned instead, and an APIError it
+        raises is counted as a failure as well but raised at once.
+        """
+        import random
+        import time
+        from httplib import HTTPException, InvalidURL
+        from urllib2 import HTTPError
+
+        if deadline is None:
+            deadline = time.time() + self.deadline
+        delay = self.backoff[0]
+        while True:
+            if not self.breaker.allow():
+                raise CircuitOpen("API failing, calls paused for {} s."
+                                  .format(self.breaker.cooldown))
+            left = deadline - time.time()
+            if left <= 0:
+                raise DeadlineExceeded("API call not completed in time.")
+            stats.count('api.calls')
+            try:
+                with stats.timer('download'):
+                    body = download(url, pool, min(self.timeout[0], left),
+                                    min(self.timeout[1], left))
+            except HTTPError as e:
+                if e.code < 500:
+                    raise
+                error = e
+            except InvalidURL:
+                raise
+            except (IOError, HTTPException) as e:
+                error = e
+            else:
+                try:
+                    result = body if parse is None else parse(body)
+                except APIError:
+                    stats.count('api.failures')
+                    self.breaker.failure()
+                    raise
+                self.breaker.success()
+                return result
+            stats.count('api.failures')
+            self.breaker.failure()
+            pause = random.uniform(0, delay)
+            if time.time() + pause >= deadline:
+                raise DeadlineExceeded("API call not completed in time, "
+                                       "last error: {}".format(error))
+            time.sleep(pause)
+            delay = min(2 * delay, self.backoff[1])
+
+    def revalidate(self, features=FEATURES):
+        """
+        Refresh the given features in a background thread.
+
+        The thread is not a daemon, so a short-lived process finishes the
+        update before exiting. Returns the thread. With the detach option
+        the update is left to a detached child process instead, so that the
+        process can exit at once, and None is returned.
+        """
+        import threading
+        from httplib import HTTPException
+
+        def run():
+            try:
+                self.refresh(features)
+            except (IOError, ValueError, HTTPException):
+                # keep using the stale data
+                pass
+
+        if self.detach:
+            return self.spawn(run)
+        if self.refreshing is None or not self.refreshing.is_alive():
+            self.refreshing = threading.Thread(target=run)
+            self.refreshing.start()
+        return self.refreshing
+
+    @staticmethod
+    def spawn(func):
+        """
+        Run func in a detached grandchild process.
+
+        The grandchild runs in its own session with the standard streams on
+        /dev/null, so that readers of our output see its end when we exit.
+        """
+        pid = os.fork()
+        if pid:
+            os.waitpid(pid, 0)
+            return None
+        try:
+            os.setsid()
+            if os.fork():
+                os._exit(0)
+            null = os.open(os.devnull, os.O_RDWR)
+            for fd in (0, 1, 2):
+                os.dup2(null, fd)
+            func()
+        finally:
+            os._exit(0)
+
+    def load(self, key):
+        """
+        Return cached model data, None if unusable.
+
+        Data cached in an older format counts as missing.
+        """
+        stored = self.cache.load(key)
+        if stored is None:
+            return None
+        try:
+            return model.load(stored)
+        except (TypeError, ValueError):
+            return None
+
+    def update(self, data):
+        """
+        Use new weather data and summarize its forecasts.
+
+        The digests of the cached features are taken along, so data has to
+        be stored or loaded before it is used.
+        """
+        digests = dict((feature, self.cache.digests.get(self.key + '.' +
+                                                        feature))
+                       for feature in FEATURES)
+        self.data = data
+        self.alert = bool(self.data.get("alerts"))
+        self.hourly = model.HourlySeries(self.data.get('hours', ()))
+        self.daily = model.DailySeries(self.data.get('days', ()))
+        # set last: a page rendered in between is tagged as the older data
+        self.digests = digests
+
+    @classmethod
+    def fetch_many(cls, queries, workers=8, **options):
+        """
+        Fetch weather for many locations concurrently.
+
+        At most workers requests are made at the same time and each worker
+        reuses its own keep-alive connections. Stale entries are refreshed
+        by the workers themselves. API calls queue for the per-minute quota
+        unless the queue option is False, so only the daily budget makes
+        fetches fail. Options are passed to the constructor.
+        Returns a dictionary mapping each query to its fetched Weather
+        instance, or to the exception raised while fetching it.
+        """
+        import threading
+        import Queue
+
+        options.setdefault('queue', True)
+        jobs = Queue.Queue()
+        for query in queries:
+            jobs.put(query)
+        results = {}
+
+        def work():
+            pool = {}
+            while True:
+                try:
+                    query = jobs.get_nowait()
+                except Queue.Empty:
+                    break
+                try:
+                    weather = cls(query, **options)
+                    weather.fetch(pool, background=False)
+                    results[query] = weather
+                except Exception as e:
+                    results[query] = e
+            for conn in pool.values():
+                conn.close()
+
+        threads = [threading.Thread(target=work)
+                   for _ in range(max(1, min(workers, jobs.qsize())))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def render(self, name):
+        """
+        Return output of the named renderer, reusing a cached copy.
+
+        Cached output is tagged with digests of the features the renderer
+        depends on, as taken with the data in use, the scale factor, font
+        size, icon folder and the code itself, so it is rendered again only
+        when one of them changes, and with the reason the data is stale.
+        """
+        digests = [self.digests.get(feature) for feature in PAGES[name]]
+        if None in digests:
+            with stats.timer('render.' + name):
+                return getattr(self, name)()
+        tag = hashlib.sha1(repr((digests, self.mult, self.size, self.path,
+                                 self.query, self.api_key, self.stale,
+                                 os.path.getmtime(__file__)))).hexdigest()
+        key = self.key + '.' + name
+        page = self.cache.page(key, tag)
+        if page is None:
+            with stats.timer('render.' + name):
+                page = getattr(self, name)()
+            self.cache.store_page(key, tag, page)
+        return page
+
+    def icon(self, name, night=False, number="0", white=False, width=None):
+        """
+        Get appropriate icon from the compiled ICON table.
+
+        With width, a copy of the icon scaled to that width is used. With
+        the icon_root option, the URL is under it, as set/name.png for icons
+        of the install folder and width/set/name.png for scaled copies.
+        """
+        key = (name, night, number, white, width)
+        if key not in self.icons:
+            if width:
+                self.icon(name, night, number, white)
+                icon = file_name(self.icons[name, night, number, white, None])
+                self.icons[key] = file_url(scaled(icon, width,
+                                                  self.home + '/icons'))
+            else:
+                if number not in ICON:
+                    number = name if name in ICON else 'na'
+                self.icons[key] = self.icons[number, night, white]
+        if self.icon_root is None:
+            return self.icons[key]
+        served = key + (self.icon_root,)
+        if served not in self.icons:
+            icon = file_name(self.icons[key])
+            for folder in (self.home + '/icons/', self.path + '/'):
+                if icon.startswith(folder):
+                    self.icons[served] = \
+                        self.icon_root + '/' + icon[len(folder):]
+                    break
+            else:
+                self.icons[served] = self.icons[key]
+        return self.icons[served]
+
+    CURRENT = Template(r"""
+        <td style="font-size: 120%;" colspan="8">
+        <img src="{icon}" width="{width}" align="left"
+        style="padding:0; margin:0;"/>{time}<br/><br/>
+        <span style="color:green; font-size:200%;">{temp}&deg;</span>
+        (feels like {feels}&deg;) <br/>
+        <span style="font-size:120%;">{weather}</span><br/>
+        <span style="font-size:80%;">Wind: <span
+        style="font-size:80%;">{wdir}</span> {wspd}</span><span
+        style="font-size:64%;">kph</span><br/>
+        <span style="font-size:80%;">{mslp}<span
+        style="font-size:64%;">hPa</span>{trend}</span></td>
+        """)
 
     def current(self):
         """ Build HTML code for current conditions. """
-        curr = self.data["current_observation"]
-        icon = self.icon(curr["icon"], curr["icon_url"])
-        time = curr["local_time_rfc822"].replace(curr["local_tz_offset"], '')
+        curr = self.data['current']
+        icon = self.icon(curr.icon, curr.night, width=int(180 * self.mult))
+        time = curr.time
+        if self.stale:
+            time = '<span style="color:gray;">' + time + ' * STALE *</span>'
         if self.alert:
             time = '<span style="color:red;">' + time + ' * ALERT *</span>'
-        html = r"""
-        <td style="font-size: 120%;" colspan="8">
-        <img src="{}" width="{}" align="left"
-        style="padding:0; margin:0;"/>{}<br/><br/>
-        <span style="color:green; font-size:200%;">{}&deg;</span>
-        (feels like {}&deg;) <br/>
-        <span style="font-size:120%;">{}</span><br/>
-        <span style="font-size:80%;">Wind: <span
-        style="font-size:80%;">{}</span> {}</span><span
-        style="font-size:64%;">kph</span><br/>
-        <span style="font-size:80%;">{}<span
-        style="font-size:64%;">hPa</span>{}</span></td>
-        """.format(icon, int(180 * MULT), time, float(curr["temp_c"]),
-                   float(curr["feelslike_c"]), curr["weather"],
-                   curr["wind_dir"], curr["wind_kph"], curr["pressure_mb"],
-                   TREND[curr["pressure_trend"]])
-        return html
+        return self.CURRENT.render(
+            icon=icon, width=int(180 * self.mult), time=time,
+            temp=curr.temp, feels=curr.feels, weather=curr.weather,
+            wdir=curr.wind_dir, wspd=curr.wind_kph, mslp=curr.pressure,
+            trend=TREND[curr.trend or self.hourly.trend])
+
+    CREDITS = Template(r"""<td colspan="2"> <a href="{url}">
+        <img src="{icon}" width="{width}"/></a>
+        </td>
+        """)
 
     def credits(self):
         """ Format Weather Underground logo. """
-        icon = self.icon("WU", "")
-        logo = self.data["current_observation"]
-        return r"""<td colspan="2"> <a href="{}"> <img src="{}" width="{}"/></a>
-        </td>
-        """.format(logo["forecast_url"], icon, int(100 * MULT))
+        icon = self.icon("WU", width=int(100 * self.mult))
+        return self.CREDITS.render(url=self.data['current'].url, icon=icon,
+                                   width=int(100 * self.mult))
 
-    def days(self):
-        """ Format daily forecast. """
-        days = self.data["forecast"]["simpleforecast"]["forecastday"]
-        rain = self.icon("rain", "")
-        snow = self.icon("snow", "")
-        html = r'<tr>'
-        totalsnow = 0.0
-        for day in days:
-            totalsnow += float(day["snow_allday"]["cm"])
-        for day in days:
-            icon = self.icon(day["icon"], day["icon_url"])
-            html += r"""
+    DAY = Template(r"""
             <td style="font-size: 100%; padding:10px 0; text-align:center;">
             <div style="width: 100%;">
-            <span style="display:block;">{}</span>
+            <span style="display:block;">{day}</span>
             </div>
-            <img src="{}" width="{}" style="padding:0 5px;"/><br/>
+            <img src="{icon}" width="{width}" style="padding:0 5px;"/><br/>
             <div style="width: 100%;">
             <span style="display:block;">
-            <span style="color:red;">{}&deg;</span>
-            <span style="color:blue;">{}&deg;</span>
+            <span style="color:red;">{high}&deg;</span>
+            <span style="color:blue;">{low}&deg;</span>
             </span></div>
             <div style="width: 100%;">
             <span style="display:block; color:blue;">
-            <img src="{}" width="{}" style="padding:0;"/>{}<span
+            <img src="{rain}" width="{small}" style="padding:0;"/>{pop}<span
             style="font-size:80%;">%</span></span>
             </div>
-            """.format(day["date"]["weekday_short"], icon, int(50 * MULT),
-                       day["high"]["celsius"], day["low"]["celsius"],
-                       rain, int(12 * MULT), day["pop"])
-            if totalsnow >= 0.1:
-                html += r"""
+            """)
+    DAY_SNOW = Template(r"""
                 <div style="width: 100%;">
                 <span style="display:block;">
-                <img src="{}" width="{}" style="padding:0;"/><span
-                style="font-size:80%;">{}</span><span
+                <img src="{snow}" width="{small}" style="padding:0;"/><span
+                style="font-size:80%;">{cm}</span><span
                 style="font-size:64%;">cm</span></span></div>
-                """.format(snow, int(10 * MULT), day["snow_allday"]["cm"])
-            html += "</td>"
-        return html + "</tr>"
+                """)
 
-    def days_large(self):
-        """ Format daily forecast with more data. """
-        days = self.data["forecast"]["simpleforecast"]["forecastday"]
-        rain = self.icon("rain", "")
-        snow = self.icon("snow", "")
-        wind = self.icon("windy", "")
-        html = r"""<body style="background-color: white;">
-        <div style="width:100%;">
-        <table style="margin:auto;"><tr>"""
-        totalsnow = 0.0
+    def days(self):
+        """ Format daily forecast. """
+        days = self.data['days']
+        width, small, tiny = (int(50 * self.mult), int(12 * self.mult),
+                              int(10 * self.mult))
+        cell = self.DAY.bind(rain=self.icon("rain", width=small),
+                             width=width, small=small)
+        snow = self.DAY_SNOW.bind(snow=self.icon("snow", width=tiny),
+                                  small=tiny)
+        html = [r'<tr>']
         for day in days:
-            totalsnow += float(day["snow_allday"]["cm"])
-        for i in range(10):
-            if i == 5:
-                html += r'</tr><tr>'
-            day = days[i]
-            icon = self.icon(day["icon"], day["icon_url"])
-            html += r"""
+            icon = self.icon(day.icon, day.night, width=width)
+            html.append(cell.render(day=day.weekday, icon=icon,
+                                    high=day.high, low=day.low, pop=day.pop))
+            if self.daily.snow_total >= 0.1:
+                html.append(snow.render(cm=day.snow))
+            html.append("</td>")
+        html.append("</tr>")
+        return ''.join(html)
+
+    DAY_LARGE = Template(r"""
             <td style="font-size: 100%; padding:20 10; text-align:center;
             ">
             <div style="width: 100%;">
-            <b style="display:block;">{}</b>
+            <b style="display:block;">{day}</b>
             </div>
-            <img src="{}" width="{}" style="padding:0;"/><br/>
+            <img src="{icon}" width="{width}" style="padding:0;"/><br/>
             <div style="width: 100%;">
-            <span style="display:block;">{}</span>
+            <span style="display:block;">{conditions}</span>
             </div>
             <div style="width: 100%;">
             <span style="display:block; font-size:120%;">
-            <span style="color:red;">{}&deg;</span>
-            <span style="color:blue;">{}&deg;</span>
+            <span style="color:red;">{high}&deg;</span>
+            <span style="color:blue;">{low}&deg;</span>
             </span></div>
             <div style="width: 100%;">
             <span style="display:block;">
-            <img src="{}" width="{}" style="padding:0;"/><span
-            style="font-size:120%; color:blue;">{}</span><span
-            style="font-size:80%; color:blue;">%</span> {}<span
+            <img src="{rain}" width="{small}" style="padding:0;"/><span
+            style="font-size:120%; color:blue;">{pop}</span><span
+            style="font-size:80%; color:blue;">%</span> {qpf}<span
             style="font-size:80%;">mm</span></span>
             </div>
             <div style="width: 100%;">
             <span style="display:block;">
-            <img src="{}" width="{}"
+            <img src="{wind}" width="{small}"
             style="padding:0;"/><span
-            style="font-size:70%;">{}</span> {}({})<span
+            style="font-size:70%;">{wdir}</span> {wspd}({wmax})<span
             style="font-size:80%;">kph</span></span>
             </div>
-            """.format(day["date"]["weekday_short"], icon, int(80 * MULT),
-                       day["conditions"], day["high"]["celsius"],
-                       day["low"]["celsius"], rain, int(16 * MULT),
-                       day["pop"], day["qpf_allday"]["mm"], wind,
-                       int(16 * MULT), day["avewind"]["dir"],
-                       day["avewind"]["kph"], day["maxwind"]["kph"])
-            if totalsnow >= 0.1:
-                html += r"""
+            """)
+    DAY_LARGE_SNOW = Template(r"""
                 <div style="width: 100%;">
                 <span style="display:block;">
-                <img src="{}" width="{}"
-                style="padding:0;"/> {}<span
+                <img src="{snow}" width="{small}"
+                style="padding:0;"/> {cm}<span
             style="font-size:80%;">cm</span></span></div>
-                """.format(snow, int(16 * MULT), day["snow_allday"]["cm"])
-            html += "</td>"
-        return html + "</tr></table></div></body>"
+                """)
+
+    def days_large(self):
+        """ Format daily forecast with more data. """
+        days = self.data['days']
+        width, small = int(80 * self.mult), int(16 * self.mult)
+        cell = self.DAY_LARGE.bind(rain=self.icon("rain", width=small),
+                                   wind=self.icon("windy", width=small),
+                                   width=width, small=small)
+        snow = self.DAY_LARGE_SNOW.bind(snow=self.icon("snow", width=small),
+                                        small=small)
+        html = [r"""<body style="background-color: white;">
+        <div style="width:100%;">
+        <table style="margin:auto;"><tr>"""]
+        for i in range(10):
+            if i == 5:
+                html.append(r'</tr><tr>')
+            day = days[i]
+            icon = self.icon(day.icon, day.night, width=width)
+            html.append(cell.render(
+                day=day.weekday, icon=icon, conditions=day.conditions,
+                high=day.high, low=day.low, pop=day.pop, qpf=day.qpf,
+                wdir=day.wind_dir, wspd=day.wind_kph, wmax=day.wind_max))
+            if self.daily.snow_total >= 0.1:
+                html.append(snow.render(cm=day.snow))
+            html.append("</td>")
+        html.append("</tr></table></div></body>")
+        return ''.join(html)
+
+    TXTDAY = Template(r"""
+            <tr><td>
+        <img src="{icon}" width="{width}" align="left"
+        style="padding:0; margin:0;"/></td><td>
+            <strong>{title}:</strong><br/> {text} </td></tr>
+        """)
 
     def txtdays(self):
         """ Format textual forecast. """
-        days = self.data["forecast"]["txt_forecast"]["forecastday"]
-        html = """<body style="background-color: white;"><table>"""
+        days = self.data['texts']
+        width = int(80 * self.mult)
+        cell = self.TXTDAY.bind(width=width)
+        html = ["""<body style="background-color: white;"><table>"""]
         for day in days:
-            icon = self.icon(day["icon"], day["icon_url"])
-            html += r"""
-            <tr><td>
-        <img src="{}" width="{}" align="left"
-        style="padding:0; margin:0;"/></td><td>
-            <strong>{}:</strong><br/> {} </td></tr>
-        """.format(icon, int(80 * MULT), day["title"], day["fcttext_metric"])
-        return html + "</table></body>"
+            icon = self.icon(day.icon, day.night, width=width)
+            html.append(cell.render(icon=icon, title=day.title,
+                                    text=day.text))
+        html.append("</table></body>")
+        return ''.join(html)
 
-    def hours(self):
-        """ Format hourly forecast. """
-        hours = self.data["hourly_forecast"]
-        rain = self.icon("rain", "")
-        snow = self.icon("snow", "")
-        cloud = self.icon("cloudy", "")
-        html = r"<tr>"
-        totalsnow = 0.0
-        for hour in hours:
-            totalsnow += float(hour["snow"]["metric"])
-        for hour in hours[:10]:
-            # if i in {8, 16} and not short:
-            #    html += r'</tr><tr>'
-            icon = self.icon(hour["icon"], hour["icon_url"], hour["fctcode"])
-            html += r"""
+    HOUR = Template(r"""
             <td style="font-size: 100%; padding:10px 0; text-align:center;">
             <div style="width: 100%;">
-            <span style="display:block;">{}:00</span>
+            <span style="display:block;">{hour}:00</span>
             </div>
-            <img src="{}" width="{}" style="padding:0 5px;"/><br/>
+            <img src="{icon}" width="{width}" style="padding:0 5px;"/><br/>
             <div style="width: 100%;">
             <span style="display:block;">
-            <span style="color:green;font-size:120%;">{}&deg;</span><span
-            style="font-size:90%;">({}&deg;)</span>
+            <span style="color:green;font-size:120%;">{temp}&deg;</span><span
+            style="font-size:90%;">({feels}&deg;)</span>
             </span></div>
             <div style="width: 100%;">
             <span style="display:block;color:blue;">
-            <img src="{}" width="{}" style="padding:0;"/>{}<span
+            <img src="{rain}" width="{small}" style="padding:0;"/>{pop}<span
             style="font-size:80%;">%</span></span>
             </div>
             <div style="width: 100%;">
             <span style="display:block;">
-            <img src="{}" width="{}" style="padding:0;"/><span
-            style="font-size:80%;">{}</span><span
+            <img src="{cloud}" width="{tiny}" style="padding:0;"/><span
+            style="font-size:80%;">{sky}</span><span
             style="font-size:60%;">%</span></span>
             </div>
-            """.format(hour["FCTTIME"]["hour"], icon, int(50 * MULT),
-                       hour["temp"]["metric"], hour["feelslike"]["metric"],
-                       rain, int(12 * MULT), hour["pop"],
-                       cloud, int(10 * MULT), hour["sky"])
-            if totalsnow >= 0.1:
-                html += r"""
+            """)
+    HOUR_SNOW = Template(r"""
                 <div style="width: 100%;">
                 <span style="display:block;">
-                <img src="{}" width="{}" style="padding:0;"/><span
-                style="font-size:80%;">{}</span><span
+                <img src="{snow}" width="{tiny}" style="padding:0;"/><span
+                style="font-size:80%;">{mm}</span><span
                 style="font-size:64%;">mm</span></span></div>
-                """.format(snow, int(10 * MULT), hour["snow"]["metric"])
-            html += "</td>"
-        return html + "</tr>"
+                """)
 
-    def hours_large(self):
-        """ Format hourly forecast with more details. """
-        hours = self.data["hourly_forecast"]
-        rain = self.icon("rain", "")
-        snow = self.icon("snow", "")
-        wind = self.icon("windy", "")
-        cloud = self.icon("cloudy", "")
-        html = r"""<body style="background-color: white;">
-        <div style="width:100%;">
-        <table style="margin:auto;"><tr>"""
-        totalsnow = 0.0
-        for hour in hours:
-            totalsnow += float(hour["snow"]["metric"])
-        for i in range(24):
-            hour = hours[i]
-            if i in {5, 10, 15, 20}:
-                html += r'</tr><tr>'
-            icon = self.icon(hour["icon"], hour["icon_url"], hour["fctcode"])
-            html += r"""
+    def hours(self):
+        """ Format hourly forecast. """
+        hours = self.data['hours']
+        width, small, tiny = (int(50 * self.mult), int(12 * self.mult),
+                              int(10 * self.mult))
+        cell = self.HOUR.bind(rain=self.icon("rain", width=small),
+                              cloud=self.icon("cloudy", width=tiny),
+                              width=width, small=small, tiny=tiny)
+        snow = self.HOUR_SNOW.bind(snow=self.icon("snow", width=tiny),
+                                   tiny=tiny)
+        html = [r"<tr>"]
+        for hour in hours[:10]:
+            # if i in {8, 16} and not short:
+            #    html += r'</tr><tr>'
+            icon = self.icon(hour.icon, hour.night, hour.code, width=width)
+            html.append(cell.render(
+                hour=hour.hour, icon=icon, temp=hour.temp, feels=hour.feels,
+                pop=hour.pop, sky=hour.sky))
+            if self.hourly.snow_total >= 0.1:
+                html.append(snow.render(mm=hour.snow))
+            html.append("</td>")
+        html.append("</tr>")
+        return ''.join(html)
+
+    HOUR_LARGE = Template(r"""
             <td style="font-size: 100%; padding:20 10; text-align:center;
             ">
             <div style="width: 100%;">
-            <b style="display:block;">{}:00</b>
+            <b style="display:block;">{hour}:00</b>
             </div>
-            <img src="{}" width="{}" style="padding:0;"/><br/>
+            <img src="{icon}" width="{width}" style="padding:0;"/><br/>
             <div style="width: 100%;">
-            <span style="display:block;">{}</span>
+            <span style="display:block;">{condition}</span>
             </div>
             <div style="width: 100%;">
             <span style="display:block; font-size:120%;">
-            <span style="font-size:120%; color:green;">{}&deg;</span><span
-            style="font-size:80%;">({}&deg;)</span>
+            <span style="font-size:120%; color:green;">{temp}&deg;</span><span
+            style="font-size:80%;">({feels}&deg;)</span>
             </span></div>
             <div style="width: 100%;">
             <span style="display:block;">
-            <img src="{}" width="{}" style="padding:0;"/><span
-            style="font-size:120%; color:blue;">{}</span><span
-            style="font-size:80%; color:blue;">%</span> {}<span
+            <img src="{rain}" width="{small}" style="padding:0;"/><span
+            style="font-size:120%; color:blue;">{pop}</span><span
+            style="font-size:80%; color:blue;">%</span> {qpf}<span
             style="font-size:80%;">mm</span></span>
             </div>
             <div style="width: 100%;">
             <span style="display:block;">
-            <img src="{}" width="{}"
+            <img src="{wind}" width="{small}"
             style="padding:0;"/><span
-            style="font-size:70%;">{}</span> {}<span
+            style="font-size:70%;">{wdir}</span> {wspd}<span
             style="font-size:80%;">kph</span></span>
             </div>
             <div style="width: 100%;">
             <span style="display:block;">
-            <img src="{}" width="{}"
-            style="padding:0;"/>{}<span
+            <img src="{cloud}" width="{small}"
+            style="padding:0;"/>{sky}<span
             style="font-size:80%;">%</span>
-            """.format(hour["FCTTIME"]["hour"], icon, int(80 * MULT),
-                       hour["condition"], hour["temp"]["metric"],
-                       hour["feelslike"]["metric"], rain, int(16 * MULT),
-                       hour["pop"], hour["qpf"]["metric"], wind, int(16 * MULT),
-                       hour["wdir"]["dir"], hour["wspd"]["metric"],
-                       cloud, int(16*MULT), hour["sky"], hour["mslp"]["metric"])
-            if totalsnow >= 0.1:
-                html += r"""
-                <img src="{}" width="{}"
-                style="padding:0;"/>{}<span
+            """)
+    HOUR_LARGE_SNOW = Template(r"""
+                <img src="{snow}" width="{small}"
+                style="padding:0;"/>{mm}<span
             style="font-size:80%;">mm</span></span>
-                """.format(snow, int(16 * MULT), hour["snow"]["metric"])
-            html += r"""
+                """)
+    HOUR_LARGE_END = Template(r"""
             <div style="width: 100%;">
-            <span style="display:block;">{}<span
+            <span style="display:block;">{mslp}<span
             style="font-size:80%;">hPa</span></span>
             </div>
-            </span></div></td>""".format(hour["mslp"]["metric"])
-        return html + "</tr></table></div></body>"
+            </span></div></td>""")
+
+    def hours_large(self):
+        """ Format hourly forecast with more details. """
+        hours = self.data['hours']
+        width, small = int(80 * self.mult), int(16 * self.mult)
+        cell = self.HOUR_LARGE.bind(rain=self.icon("rain", width=small),
+                                    wind=self.icon("windy", width=small),
+                                    cloud=self.icon("cloudy", width=small),
+                                    width=width, small=small)
+        snow = self.HOUR_LARGE_SNOW.bind(snow=self.icon("snow", width=small),
+                                         small=small)
+        end = self.HOUR_LARGE_END
+        html = [r"""<body style="background-color: white;">
+        <div style="width:100%;">
+        <table style="margin:auto;"><tr>"""]
+        for i in range(24):
+            hour = hours[i]
+            if i in {5, 10, 15, 20}:
+                html.append(r'</tr><tr>')
+            icon = self.icon(hour.icon, hour.night, hour.code, width=width)
+            html.append(cell.render(
+                hour=hour.hour, icon=icon, condition=hour.condition,
+                temp=hour.temp, feels=hour.feels, pop=hour.pop, qpf=hour.qpf,
+                wdir=hour.wind_dir, wspd=hour.wind_kph, sky=hour.sky))
+            if self.hourly.snow_total >= 0.1:
+                html.append(snow.render(mm=hour.snow))
+            html.append(end.render(mslp=hour.pressure))
+        html.append("</tr></table></div></body>")
+        return ''.join(html)
 
     def build_main(self):
         """ Build main HTML file. """
@@ -458,142 +1102,360 @@ class Weather(object):
             + self.days() + end
         return html
 
+    ALERT = Template(r"""<p> <b> {description} </b> Expires: {expires}.</br>
+            {message}</p>""")
+
     def alerts(self):
         """ Format alerts. """
         if not self.alert:
             return ""
-        html = r"""<html><body style="background-color: white;">"""
-        for alert in self.data["alerts"]:
-            html += r"""<p> <b> {} </b> Expires: {}.</br>
-            {}</p>""".format(alert["description"], alert["expires"],
-                             re.sub(r'[\s\n]+', ' ',
-                                    alert["message"].replace('\n\n', '<br/>')))
-        return html + "</body></html>"
+        html = [r"""<html><body style="background-color: white;">"""]
+        for alert in self.data['alerts']:
+            html.append(self.ALERT.render(
+                description=alert.description, expires=alert.expires,
+                message=re.sub(r'[\s\n]+', ' ',
+                               alert.message.replace('\n\n', '<br/>'))))
+        html.append("</body></html>")
+        return ''.join(html)
 
-    def message(self):
-        """ Format JSON weather summary message. """
-        curr = self.data["current_observation"]
-        hours = self.data["hourly_forecast"]
-        icon = self.icon(curr["icon"], curr["icon_url"], white=True)
-        action = '{}/weather.py "{}" -m{} -k {}'.format(self.path, QUERY, MULT,
-                                                        API_KEY)
-        with open(self.home + '/clickaction', 'w') as f:
-            print >>f, """#!/bin/bash
-(
-  flock -xn 200 || exit 1
-  {}
-) 200>/var/lock/.weather.exclusivelock
-""".format(action)
-        os.system('chmod +x ' + self.home + '/clickaction')
-        small = int(args.size * 0.45)
-        message = """
+    def summary(self):
+        """ Return one line summary of the hourly forecast. """
+        hourly = self.hourly
+        if hourly.temp_min is None:
+            return ""
+        parts = ["{:g} to {:g} C".format(hourly.temp_min, hourly.temp_max)]
+        if hourly.onset is not None:
+            parts.append("precipitation from {}:00".format(hourly.onset))
+        parts.append({'+': "pressure rising", '-': "pressure falling",
+                      '0': "pressure steady"}[hourly.trend])
+        snow = model.total(hourly.snow[:24])
+        if snow >= 0.1:
+            parts.append("{:g} mm of snow".format(snow))
+        return "Next {} hours: {}.".format(min(hourly.size, 24),
+                                           ', '.join(parts))
+
+    MESSAGE = Template(r"""
         <xml>
         <appsettings>
-            <tooltip>Weather summary for %s.
-            Current conditions, then next few hours. </tooltip>
-            <clickaction>%s</clickaction>
+            <tooltip>Weather summary for {query}.
+            Current conditions, then next few hours.
+            {summary}{stale}</tooltip>
+            <clickaction>{action}</clickaction>
         </appsettings>
         <item>
             <type>icon</type>
-            <value>%s</value>
+            <value>{icon}</value>
             <attr>
-                <style>icon-size: {4}pt;</style>
+                <style>icon-size: {icon_size}pt;</style>
             </attr>
         </item>
         <item>
             <type>text</type>
-            <value> %s </value>
+            <value> {weather} </value>
             <attr>
-                <style>font-size: {3}pt; color:white</style>
+                <style>font-size: {text}pt; color:white</style>
             </attr>
         </item>
         <item>
             <type>text</type>
-            <value>%s</value>
+            <value>{temp}</value>
             <attr>
-                <style>font-size: {0}pt; color:white</style>
+                <style>font-size: {size}pt; color:white</style>
             </attr>
         </item>
         <item>
             <type>text</type>
             <value>O</value>
             <attr>
-            <style>font-size: {1}pt; color:white; padding-bottom:{2}pt;</style>
+            <style>font-size: {small}pt; color:white;
+            padding-bottom:{pad}pt;</style>
             </attr>
         </item>
         <item>
             <type>text</type>
             <value> | </value>
             <attr>
-                <style>font-size: {0}pt; color:white</style>
+                <style>font-size: {size}pt; color:white</style>
             </attr>
         </item>
-        """ % (QUERY, self.home + '/clickaction', icon, curr["weather"],
-               int(curr["temp_c"]))
-        message = message.format(args.size, small,
-                                 args.size - small - args.size % 4,
-                                 int(args.size * 0.8), int(args.size * 1.1))
-        args.size = int(args.size * 0.85)
-        small = int(args.size * 0.45)
-        for hour in hours[0:5:2]:
-            icon = self.icon(hour["icon"], hour["icon_url"], hour["fctcode"],
-                             white=True)
-            message += """
+        """)
+    MESSAGE_HOUR = Template(r"""
             <item>
             <type>icon</type>
-            <value>%s</value>
+            <value>{icon}</value>
             <attr>
-                <style>icon-size: {4}pt;</style>
+                <style>icon-size: {icon_size}pt;</style>
             </attr>
             </item>
             <item>
                 <type>text</type>
-                <value>%s</value>
+                <value>{temp}</value>
                 <attr>
-                    <style>font-size: {0}pt; color:white</style>
+                    <style>font-size: {size}pt; color:white</style>
                 </attr>
             </item>
             <item>
                 <type>text</type>
                 <value>O</value>
                 <attr>
-                <style>font-size: {1}pt; color:white; padding-bottom:{2}pt;
+                <style>font-size: {small}pt; color:white;
+                padding-bottom:{pad}pt;
                 </style>
                 </attr>
             </item>
             <item>
                 <type>text</type>
-                <value>%s%% </value>
+                <value>{pop}% </value>
                 <attr>
-                    <style>font-size: {3}pt; color:white</style>
+                    <style>font-size: {text}pt; color:white</style>
                 </attr>
             </item>
-            """ % (icon, hour["temp"]["metric"], hour["pop"])
-        message += '</xml>'
-        print message.format(args.size, small,
-                             args.size - small - args.size % 4,
-                             int(args.size * 0.8), int(args.size * 1.1))
+            """)
 
+    CLICKACTION = """#!/bin/bash
+pid=$(cat {0} 2>/dev/null)
+[ -n "$pid" ] && grep -qsa weather.py /proc/$pid/cmdline \
+  && kill -USR1 $pid && exit 0
+(
+  flock -xn 200 || exit 1
+  {1}
+) 200>/var/lock/.weather.exclusivelock
+"""
 
-if __name__ == "__main__":
-    # build tabs
-    weather = Weather(QUERY, min=2)
-    weather.fetch()
+    def clickaction(self):
+        """
+        Write the click action script of the panel if it changed.
 
-    # JSON message and exit
-    if args.update:
-        weather.message()
-        exit(0)
-
-    # build interface
-    tabs = [(weather.build_main(), "Summary", MULT),
-            (weather.hours_large(), "Next 24 hours", MULT),
-            (weather.days_large(), "Forecast 10 days", MULT),
-            (weather.txtdays(), "Text forecast", MULT)]
+        The script pops up the resident window if there is one, otherwise
+        starts the app. Only the panel's own process should write it, as
+        there is one per user.
+        """
+        command = '{}/weather.py "{}" -m{} -k {} -f {}'.format(
+            self.path, self.query, self.mult, self.api_key, self.format)
+        command += ' -q {},{} -t {:g}'.format(
+            self.quota.per_minute, self.quota.per_day, self.deadline)
+        script = self.CLICKACTION.format(self.pidfile, command) + '\n'
+        try:
+            # a plain read, the script is no cache entry to mark as used
+            with open(self.action, 'r') as f:
+                old = f.read()
+        except IOError:
+            old = None
+        if old != script:
+            self.cache.write(self.action, script)
+            os.chmod(self.action, 0o755)
+
+    @staticmethod
+    def sizes(size):
+        """ Return message font sizes of the temperature. """
+        small = int(size * 0.45)
+        return dict(size=size, small=small, pad=size - small - size % 4,
+                    text=int(size * 0.8), icon_size=int(size * 1.1))
+
+    def message(self):
+        """
+        Return JSON weather summary message.
+
+        The message refers to the click action script by name only, which
+        is written by clickaction().
+        """
+        from cgi import escape
+
+        curr = self.data['current']
+        stale = ""
+        if self.stale:
+            stale = "\n            Data is stale. " + escape(self.stale)
+        html = [self.MESSAGE.bind(**self.sizes(self.size)).render(
+            query=self.query, summary=self.summary(), stale=stale,
+            action=text(self.action),
+            icon=self.icon(curr.icon, curr.night, white=True),
+            weather=curr.weather,
+            temp=None if curr.temp is None else int(curr.temp))]
+        hour = self.MESSAGE_HOUR.bind(**self.sizes(int(self.size * 0.85)))
+        for point in self.data['hours'][0:5:2]:
+            html.append(hour.render(
+                icon=self.icon(point.icon, point.night, point.code,
+                               white=True),
+                temp=point.temp, pop=point.pop))
+        html.append('</xml>')
+        return ''.join(html)
+
+
+def build_tabs(weather):
+    """ Return GUI tabs for fetched weather, rendered on demand. """
+    from functools import partial
+
+    mult = weather.mult
+    tabs = [(partial(weather.render, 'build_main'), "Summary", mult),
+            (partial(weather.render, 'hours_large'), "Next 24 hours", mult),
+            (partial(weather.render, 'days_large'), "Forecast 10 days", mult),
+            (partial(weather.render, 'txtdays'), "Text forecast", mult)]
     if weather.alert:
-        tabs.append((weather.alerts(), "*** ALERT ***", MULT))
+        tabs.append((partial(weather.render, 'alerts'), "*** ALERT ***",
+                     mult))
+    return tabs
 
+
+def rendered_tabs(weather, previous=None):
+    """
+    Fetch weather and yield its GUI tabs rendered, Summary first.
+
+    Meant to run in a background thread. Nothing is yielded if the fetched
+    data and its staleness equal the previous ones, given as a tuple.
+    """
+    weather.fetch()
+    if previous is not None and (weather.data, weather.stale) == previous:
+        return
+    for render, name, resize in build_tabs(weather):
+        yield render(), name, resize
+
+
+def parse_args(argv=None):
+    """ Parse command line arguments. """
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Fetch weather and show results.')
+    parser.add_argument('location', type=str, help='weather location')
+    parser.add_argument('-m', '--mult', type=float, default=1.0,
+                        help='resize GUI by the given factor')
+    parser.add_argument('-k', '--key', type=str, default="",
+                        help='Weather Underground API key')
+    parser.add_argument('-u', '--update', action='store_true', default=False,
+                        help='update files without showing GUI')
+    parser.add_argument('-s', '--size', type=int, default=12,
+                        help='font size for the message string')
+    parser.add_argument('-r', '--resident', action='store_true',
+                        default=False,
+                        help='keep hidden GUI ready to pop up on click action')
+    parser.add_argument('-d', '--daemon', action='store_true', default=False,
+                        help='keep serving update messages on a Unix socket')
+    parser.add_argument('-f', '--format', type=str, default='marshal',
+                        choices=sorted(SERIALIZERS),
+                        help='format of cached data')
+    parser.add_argument('-q', '--quota', metavar='MINUTE,DAY',
+                        type=lambda text: tuple(int(n)
+                                                for n in text.split(',')),
+                        default=(10, 500),
+                        help='API calls allowed per minute and per day')
+    parser.add_argument('-t', '--deadline', type=float, default=15.0,
+                        help='seconds to wait for the API before showing '
+                        'older data')
+    parser.add_argument('-l', '--live', type=int, default=30,
+                        help='seconds between live updates of the shown '
+                        'window, 0 to disable')
+    parser.add_argument('-c', '--changed', action='store_true',
+                        default=False,
+                        help='with -u, print nothing if the update is the '
+                        'same as the last one printed')
+    parser.add_argument('-S', '--stats', action='store_true', default=False,
+                        help='log timings and counters to '
+                        '~/.weather/stats.log')
+    parser.add_argument('--probe', action='store_true', default=False,
+                        help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def gui(weather, resident=False, probe=False, live=30):
+    """
+    Show the weather in a popup window.
+
+    The window shows up at once, while the weather is fetched and rendered
+    in a background thread, filling in the tabs as they are ready. While it
+    is shown, newer data is looked for every live seconds (unless live is 0)
+    and patched into the loaded tabs. A resident window stays hidden until
+    the click action signals it, then updates its tabs the same way. With
+    probe, print 'loaded' when the Summary tab is loaded and quit.
+    """
+    from PyQt4.QtCore import QTimer
     from quicktabs import QuickTabs
-    app, win = QuickTabs.App(100 + 640 * MULT, 100 + 480 * MULT)
-    win.addTabs(tabs)
-    app.exec_()
+
+    def update():
+        if win.isVisible():
+            previous = weather.data, weather.stale
+            win.loadTabs(lambda: rendered_tabs(weather, previous), live=True)
+
+    app, win = QuickTabs.App(100 + 640 * weather.mult,
+                             100 + 480 * weather.mult,
+                             show=not resident)
+    win.loadTabs(lambda: rendered_tabs(weather))
+    if probe:
+        # startup benchmark: report first tab loaded and quit
+        def loaded(ok):
+            print 'loaded'
+            app.quit()
+
+        def filled(index):
+            if index == 0:
+                win.widget(0).load().loadFinished.connect(loaded)
+
+        win.filled.connect(filled)
+    if live:
+        timer = QTimer(win)
+        timer.timeout.connect(update)
+        timer.start(live * 1000)
+    if not resident:
+        app.exec_()
+        return
+
+    # stay hidden until the click action signals us
+    def reload():
+        weather.quota.view(weather.key)
+        update()
+
+    win.listen(reload)
+    with open(weather.pidfile, 'w') as f:
+        print >>f, os.getpid()
+    try:
+        app.exec_()
+    finally:
+        os.unlink(weather.pidfile)
+
+
+def main(argv=None):
+    """ Run the command line application. """
+    args = parse_args(argv)
+
+    # running daemon with the same options answers update requests
+    if args.update and not args.daemon:
+        import panel
+        options = args.location, args.size, args.mult, args.format
+        # digest of the last update printed, for changed-only updates
+        printed = panel.stem(*options) + '.printed'
+        # a new key is saved and used by the direct path
+        if not args.key and panel.answer(*options,
+                                         if_changed=args.changed):
+            return
+
+    weather = Weather(args.location, key=args.key, mult=args.mult,
+                      size=args.size, format=args.format, quota=args.quota,
+                      deadline=args.deadline,
+                      detach=args.update and not args.daemon)
+    if args.stats:
+        stats.enable(weather.home + '/stats.log')
+    if not args.daemon:
+        weather.quota.view(weather.key)
+
+    # build interface, fetching in the background
+    if not (args.daemon or args.update):
+        gui(weather, args.resident, args.probe, args.live)
+        return
+    weather.fetch()
+
+    # keep serving JSON messages
+    if args.daemon:
+        from daemon import PanelDaemon
+        PanelDaemon(weather).run()
+        return
+
+    # JSON message and exit
+    weather.clickaction()
+    message = weather.render('message')
+    if isinstance(message, unicode):
+        message = message.encode('utf-8')
+    if not args.changed or panel.changed(message, printed):
+        print message
+
+
+if __name__ == "__main__":
+    main()